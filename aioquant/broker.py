@@ -0,0 +1,528 @@
+# -*- coding:utf-8 -*-
+
+"""
+In-memory AMQP broker, a stand-in for RabbitMQ + aioamqp, so that EventCenter can be tested and benchmarked without
+a RabbitMQ server. Set `RABBITMQ.transport` to `memory` in config file to use it.
+
+Supported:
+    a) `direct` / `fanout` / `topic` exchanges, topic bindings with `*` and `#`;
+    b) named / server-named queues, `exclusive` and `auto_delete` queues, bind / unbind / delete, queue arguments
+        `x-max-length` (with `x-overflow` `drop-head` / `reject-publish`) and `x-message-ttl`, `x-queue-mode` is
+        accepted and ignored, declaring a existing queue with different arguments is a channel error (406);
+    c) consumers with `no_ack`, `basic_qos` prefetch window, `basic_client_ack` (with `multiple`), `basic_client_nack`
+        / `basic_reject` with requeue, unacknowledged messages are requeued if their channel is closed;
+    d) publisher confirms (`confirm_select`), `basic_server_ack` of the publishing channel is called for every message;
+    e) deliveries of a connection are awaited one by one in order, like aioamqp does;
+    f) a RPC (e.g. `queue_declare`) is answered on the next loop iteration, and a second RPC of the same method sent
+        on a channel before the first one answered raises `SynchronizationError`, like aioamqp does.
+
+Author: HuangTao
+Date:   2019/11/29
+Email:  huangtao@ifclover.com
+"""
+
+import asyncio
+import itertools
+from types import SimpleNamespace
+from collections import deque, OrderedDict
+
+from aioamqp.envelope import Envelope
+from aioamqp.properties import Properties
+from aioamqp.protocol import OPEN, CLOSED
+from aioamqp.exceptions import ChannelClosed, AmqpClosedConnection, SynchronizationError
+
+from aioquant.utils import tools
+
+__all__ = ("MemoryBroker", "MemoryProtocol", "MemoryChannel", "broker", )
+
+
+class _Queue:
+    """Queue in memory broker."""
+
+    def __init__(self, name, exclusive=None, auto_delete=False, arguments=None):
+        self.name = name
+        self.exclusive = exclusive  # Owner connection of a exclusive queue.
+        self.auto_delete = auto_delete
+        self.arguments = arguments or {}
+        self.max_length = self.arguments.get("x-max-length")
+        self.overflow = self.arguments.get("x-overflow", "drop-head")
+        self.ttl = self.arguments.get("x-message-ttl")  # Millisecond.
+        self.messages = deque()  # e.g. `deque([(exchange, routing_key, payload, properties, redelivered, expires)])`
+        self.consumers = []  # e.g. `[(channel, consumer_tag), ...]`
+        self.next_consumer = 0  # Round robin index of consumers.
+        self.dropped = 0  # Messages dropped by `x-max-length`.
+        self.expired = 0  # Messages expired by `x-message-ttl`.
+
+    def put(self, message):
+        """Put a message to the tail, the head is dropped if the queue is full (or the message is dropped if
+        `x-overflow` is `reject-publish`)."""
+        if self.max_length is not None and len(self.messages) >= self.max_length:
+            self.dropped += 1
+            if self.overflow != "drop-head":
+                return
+            if self.messages:
+                self.messages.popleft()
+            else:
+                return
+        self.messages.append(message)
+
+
+class MemoryBroker:
+    """In-memory AMQP broker.
+
+    Attributes:
+        stats: Running statistics, e.g. `{"published": 100, "routed": 100, "delivered": 100, "acked": 100, "queues":
+            {"amq.gen-xxx": {"messages": 0, "consumers": 1, "dropped": 0, "expired": 0}}}`.
+    """
+
+    def __init__(self):
+        """Initialize."""
+        self._exchanges = {"": "direct"}  # e.g. `{"Orderbook": "topic"}`
+        self._bindings = {}  # e.g. `{"Orderbook": [(routing_key, queue_name), ...]}`
+        self._routes = {}  # Matched queues cache, e.g. `{("Orderbook", "binance.ETH/BTC"): [queue_name, ...]}`
+        self._queues = {}  # e.g. `{"amq.gen-xxx": queue}`
+        self._protocols = []  # Open connections.
+        self._published = 0
+        self._routed = 0
+        self._delivered = 0
+        self._acked = 0
+
+    @property
+    def stats(self):
+        d = {
+            "published": self._published,
+            "routed": self._routed,
+            "delivered": self._delivered,
+            "acked": self._acked,
+            "queues": {name: {"messages": len(queue.messages), "consumers": len(queue.consumers),
+                              "dropped": queue.dropped, "expired": queue.expired}
+                       for name, queue in self._queues.items()}
+        }
+        return d
+
+    async def connect(self, *args, **kwargs):
+        """Open a connection, the same signature as `aioamqp.connect`, all arguments are ignored.
+
+        Returns:
+            transport: Always None.
+            protocol: Connection.
+        """
+        protocol = MemoryProtocol(self)
+        self._protocols.append(protocol)
+        return None, protocol
+
+    def close_connections(self):
+        """Close all connections as if the server was gone, used to test re-connection."""
+        for protocol in list(self._protocols):
+            protocol.connection_lost()
+
+    def exchange_declare(self, exchange_name, type_name):
+        if exchange_name in self._exchanges and self._exchanges[exchange_name] != type_name:
+            raise ChannelClosed(406, "PRECONDITION_FAILED - inequivalent arg 'type' for exchange " + exchange_name)
+        self._exchanges[exchange_name] = type_name
+        self._bindings.setdefault(exchange_name, [])
+
+    def queue_declare(self, protocol, queue_name, exclusive, auto_delete, arguments):
+        if not queue_name:
+            queue_name = "amq.gen-" + tools.get_uuid4()
+        queue = self._queues.get(queue_name)
+        if not queue:
+            queue = _Queue(queue_name, protocol if exclusive else None, auto_delete, arguments)
+            self._queues[queue_name] = queue
+            self._routes = {}
+        elif queue.exclusive and queue.exclusive is not protocol:
+            raise ChannelClosed(405, "RESOURCE_LOCKED - cannot obtain exclusive access to queue " + queue_name)
+        elif queue.arguments != (arguments or {}):
+            raise ChannelClosed(406, "PRECONDITION_FAILED - inequivalent arg for queue " + queue_name)
+        return queue
+
+    def get_queue(self, queue_name):
+        queue = self._queues.get(queue_name)
+        if not queue:
+            raise ChannelClosed(404, "NOT_FOUND - no queue '{}'".format(queue_name))
+        return queue
+
+    def queue_bind(self, queue_name, exchange_name, routing_key):
+        self.get_queue(queue_name)
+        if exchange_name not in self._exchanges:
+            raise ChannelClosed(404, "NOT_FOUND - no exchange '{}'".format(exchange_name))
+        binding = (routing_key, queue_name)
+        if binding not in self._bindings[exchange_name]:
+            self._bindings[exchange_name].append(binding)
+            self._routes = {}
+
+    def queue_unbind(self, queue_name, exchange_name, routing_key):
+        binding = (routing_key, queue_name)
+        if binding in self._bindings.get(exchange_name, []):
+            self._bindings[exchange_name].remove(binding)
+            self._routes = {}
+
+    def queue_delete(self, queue_name):
+        """Delete a queue, the messages in it are dropped and it's consumers are cancelled.
+
+        Returns:
+            count: How many messages dropped.
+        """
+        queue = self._queues.pop(queue_name, None)
+        if not queue:
+            return 0
+        for bindings in self._bindings.values():
+            bindings[:] = [binding for binding in bindings if binding[1] != queue_name]
+        self._routes = {}
+        for channel, consumer_tag in queue.consumers:
+            channel.consumer_cancelled(consumer_tag)
+        return len(queue.messages)
+
+    def route(self, exchange_name, routing_key):
+        """Get the queue names matched by a routing key."""
+        key = (exchange_name, routing_key)
+        names = self._routes.get(key)
+        if names is not None:
+            return names
+        type_name = self._exchanges.get(exchange_name)
+        if exchange_name == "":
+            names = [routing_key] if routing_key in self._queues else []
+        elif type_name == "fanout":
+            names = [name for _, name in self._bindings[exchange_name]]
+        elif type_name == "topic":
+            names = [name for pattern, name in self._bindings[exchange_name] if tools.topic_match(pattern, routing_key)]
+        else:
+            names = [name for k, name in self._bindings.get(exchange_name, []) if k == routing_key]
+        names = list(OrderedDict.fromkeys(names))  # A queue gets one copy even if bound many times.
+        self._routes[key] = names
+        return names
+
+    def publish(self, exchange_name, routing_key, payload, properties):
+        """Route a message into the matched queues and dispatch.
+
+        Returns:
+            count: How many queues routed.
+        """
+        if exchange_name not in self._exchanges:
+            raise ChannelClosed(404, "NOT_FOUND - no exchange '{}'".format(exchange_name))
+        self._published += 1
+        names = self.route(exchange_name, routing_key)
+        now = asyncio.get_event_loop().time()
+        for name in names:
+            queue = self._queues[name]
+            expires = now + queue.ttl / 1000 if queue.ttl is not None else None
+            queue.put((exchange_name, routing_key, payload, properties, False, expires))
+            self._routed += 1
+            self.dispatch(queue)
+        return len(names)
+
+    def requeue(self, queue_name, messages):
+        """Put messages back to the head of a queue, they are marked as redelivered and keep their expiration."""
+        queue = self._queues.get(queue_name)
+        if not queue:
+            return
+        for exchange_name, routing_key, payload, properties, _, expires in reversed(messages):
+            queue.messages.appendleft((exchange_name, routing_key, payload, properties, True, expires))
+        self.dispatch(queue)
+
+    def dispatch(self, queue):
+        """Deliver messages of a queue to it's consumers round robin, as long as their prefetch windows allow, the
+        expired messages are dropped."""
+        now = asyncio.get_event_loop().time()
+        while queue.messages and queue.messages[0][5] is not None and queue.messages[0][5] <= now:
+            queue.messages.popleft()
+            queue.expired += 1
+        while queue.messages and queue.consumers:
+            for _ in range(len(queue.consumers)):
+                index = queue.next_consumer % len(queue.consumers)
+                queue.next_consumer = index + 1
+                channel, consumer_tag = queue.consumers[index]
+                if channel.can_deliver(consumer_tag):
+                    break
+            else:
+                return
+            message = queue.messages.popleft()
+            if message[5] is not None and message[5] <= now:
+                queue.expired += 1
+                continue
+            channel.deliver(queue.name, consumer_tag, message)
+            self._delivered += 1
+
+    def consumer_removed(self, queue):
+        """Delete a auto delete queue after it's last consumer is gone."""
+        if queue.auto_delete and not queue.consumers and queue.name in self._queues:
+            self.queue_delete(queue.name)
+
+    def protocol_closed(self, protocol):
+        if protocol in self._protocols:
+            self._protocols.remove(protocol)
+        for name, queue in list(self._queues.items()):
+            if queue.exclusive is protocol:
+                self.queue_delete(name)
+
+
+class MemoryProtocol:
+    """Connection of memory broker, the same interface as `aioamqp.protocol.AmqpProtocol` used by EventCenter.
+
+    * NOTE:
+        All deliveries, confirms and cancels of a connection are awaited one by one in a single task, so a slow
+        callback delays the other channels of the same connection, the same as aioamqp.
+    """
+
+    def __init__(self, broker: MemoryBroker):
+        """Initialize."""
+        self.broker = broker
+        self.channels = {}
+        self.state = OPEN
+        self._channel_id = itertools.count(1)
+        self._frames = deque()  # e.g. `deque([(coroutine function, args), ...])`
+        self._frame_waiter = asyncio.Event()
+        self._reader = asyncio.get_event_loop().create_task(self._read_frames())
+
+    @property
+    def is_open(self):
+        return self.state == OPEN
+
+    async def channel(self):
+        if not self.is_open:
+            raise AmqpClosedConnection()
+        channel = MemoryChannel(self, next(self._channel_id))
+        self.channels[channel.channel_id] = channel
+        return channel
+
+    async def close(self, no_wait=False, timeout=None):
+        self.connection_lost()
+
+    def connection_lost(self):
+        if not self.is_open:
+            return
+        self.state = CLOSED
+        for channel in list(self.channels.values()):
+            channel.connection_closed()
+        self.broker.protocol_closed(self)
+        self._frames.clear()
+        self._reader.cancel()
+
+    def send_frame(self, func, *args):
+        """Schedule a callback to be awaited by the reader task."""
+        self._frames.append((func, args))
+        self._frame_waiter.set()
+
+    async def _read_frames(self):
+        while True:
+            await self._frame_waiter.wait()
+            self._frame_waiter.clear()
+            while self._frames:
+                func, args = self._frames.popleft()
+                await func(*args)
+
+
+class MemoryChannel:
+    """Channel of memory broker, the same interface as `aioamqp.channel.Channel` used by EventCenter."""
+
+    def __init__(self, protocol: MemoryProtocol, channel_id):
+        """Initialize."""
+        self.protocol = protocol
+        self.broker = protocol.broker
+        self.channel_id = channel_id
+        self.close_event = asyncio.Event()
+        self.publisher_confirms = False
+        self._prefetch_count = 0  # Unlimited.
+        self._consumers = {}  # e.g. `{consumer_tag: (queue_name, callback, no_ack)}`
+        self._unacked = OrderedDict()  # e.g. `{delivery_tag: (queue_name, message)}`
+        self._delivery_tag = 0
+        self._publish_tag = 0
+        self._waiters = set()  # RPC methods waiting for response, e.g. `{"queue_declare"}`
+
+    @property
+    def is_open(self):
+        return not self.close_event.is_set()
+
+    def _check_open(self):
+        if not self.is_open:
+            raise ChannelClosed()
+
+    def _call(self, func, *args):
+        """Call a broker method, a channel error closes the channel, the same as RabbitMQ."""
+        self._check_open()
+        try:
+            return func(*args)
+        except ChannelClosed:
+            self.connection_closed()
+            raise
+
+    async def _rpc(self, name, func, *args):
+        """Send a RPC and wait for the response, the broker method is called on the next loop iteration."""
+        self._check_open()
+        if name in self._waiters:
+            raise SynchronizationError("Waiter already exists")
+        self._waiters.add(name)
+        try:
+            await asyncio.sleep(0)
+            return self._call(func, *args)
+        finally:
+            self._waiters.discard(name)
+
+    async def close(self, reply_code=0, reply_text="Normal Shutdown"):
+        await self._rpc("close", self.connection_closed)
+
+    def connection_closed(self):
+        """Cancel all consumers and requeue all unacknowledged messages of this channel."""
+        if not self.is_open:
+            return
+        self.close_event.set()
+        self.protocol.channels.pop(self.channel_id, None)
+        for consumer_tag in list(self._consumers):
+            self._remove_consumer(consumer_tag)
+        self._requeue(list(self._unacked))
+
+    async def exchange_declare(self, exchange_name, type_name, passive=False, durable=False, auto_delete=False,
+                               no_wait=False, arguments=None):
+        await self._rpc("exchange_declare", self.broker.exchange_declare, exchange_name, type_name)
+        return True
+
+    async def queue_declare(self, queue_name=None, passive=False, durable=False, exclusive=False, auto_delete=False,
+                            no_wait=False, arguments=None):
+        queue = await self._rpc("queue_declare", self.broker.queue_declare, self.protocol, queue_name, exclusive,
+                                auto_delete, arguments)
+        result = {
+            "queue": queue.name,
+            "message_count": len(queue.messages),
+            "consumer_count": len(queue.consumers)
+        }
+        return result
+
+    async def queue_bind(self, queue_name, exchange_name, routing_key, no_wait=False, arguments=None):
+        await self._rpc("queue_bind", self.broker.queue_bind, queue_name, exchange_name, routing_key)
+        return True
+
+    async def queue_unbind(self, queue_name, exchange_name, routing_key, arguments=None):
+        await self._rpc("queue_unbind", self.broker.queue_unbind, queue_name, exchange_name, routing_key)
+        return True
+
+    async def queue_delete(self, queue_name, if_unused=False, if_empty=False, no_wait=False):
+        return await self._rpc("queue_delete", self.broker.queue_delete, queue_name)
+
+    async def basic_qos(self, prefetch_size=0, prefetch_count=0, connection_global=False):
+        await self._rpc("basic_qos", setattr, self, "_prefetch_count", prefetch_count)
+        return True
+
+    async def basic_consume(self, callback, queue_name="", consumer_tag="", no_local=False, no_ack=False,
+                            exclusive=False, no_wait=False, arguments=None):
+        queue = await self._rpc("basic_consume", self.broker.get_queue, queue_name)
+        consumer_tag = consumer_tag or "ctag{}.{}".format(self.channel_id, tools.get_uuid4())
+        self._consumers[consumer_tag] = (queue_name, callback, no_ack)
+        queue.consumers.append((self, consumer_tag))
+        self.broker.dispatch(queue)
+        return {"consumer_tag": consumer_tag}
+
+    async def basic_cancel(self, consumer_tag, no_wait=False):
+        await self._rpc("basic_cancel", self._remove_consumer, consumer_tag)
+        return {"consumer_tag": consumer_tag}
+
+    def _remove_consumer(self, consumer_tag):
+        queue_name, _, _ = self._consumers.pop(consumer_tag, (None, None, None))
+        queue = self.broker._queues.get(queue_name)
+        if queue:
+            queue.consumers.remove((self, consumer_tag))
+            self.broker.consumer_removed(queue)
+
+    def consumer_cancelled(self, consumer_tag):
+        """The queue of a consumer is deleted by the broker."""
+        self._consumers.pop(consumer_tag, None)
+
+    def can_deliver(self, consumer_tag):
+        """If a consumer's prefetch window allows one more message."""
+        if self._consumers[consumer_tag][2]:
+            return True
+        return not self._prefetch_count or len(self._unacked) < self._prefetch_count
+
+    def deliver(self, queue_name, consumer_tag, message):
+        _, callback, no_ack = self._consumers[consumer_tag]
+        exchange_name, routing_key, payload, properties, redelivered, _ = message
+        self._delivery_tag += 1
+        if not no_ack:
+            self._unacked[self._delivery_tag] = (queue_name, message)
+        envelope = Envelope(consumer_tag, self._delivery_tag, exchange_name, routing_key, redelivered)
+        self.protocol.send_frame(self._deliver, callback, payload, envelope, properties)
+
+    async def _deliver(self, callback, payload, envelope, properties):
+        if self.is_open:  # Messages of a closed channel have been requeued.
+            await callback(self, payload, envelope, properties)
+
+    async def basic_publish(self, payload, exchange_name, routing_key, properties=None, mandatory=False,
+                            immediate=False):
+        self._check_open()
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self._call(self.broker.publish, exchange_name, routing_key, payload, Properties(**(properties or {})))
+        if self.publisher_confirms:
+            self._publish_tag += 1
+            frame = SimpleNamespace(delivery_tag=self._publish_tag, multiple=False)
+            self.protocol.send_frame(self._server_ack, frame)
+
+    async def publish(self, payload, exchange_name, routing_key, properties=None, mandatory=False, immediate=False):
+        await self.basic_publish(payload, exchange_name, routing_key, properties, mandatory, immediate)
+        return True
+
+    async def _server_ack(self, frame):
+        if self.is_open:
+            await self.basic_server_ack(frame)
+
+    async def confirm_select(self, *, no_wait=False):
+        await self._rpc("confirm_select", setattr, self, "publisher_confirms", True)
+        return True
+
+    async def basic_server_ack(self, frame):
+        """Publisher confirm callback, replaced by the user."""
+
+    async def basic_server_nack(self, frame):
+        """Publisher negative confirm callback, replaced by the user."""
+
+    async def basic_client_ack(self, delivery_tag, multiple=False):
+        self._check_open()
+        tags = self._pop_tags(delivery_tag, multiple)
+        self.broker._acked += len(tags)
+        self._dispatch_queues(queue_name for queue_name, _ in tags)
+
+    async def basic_client_nack(self, delivery_tag, multiple=False, requeue=True):
+        self._check_open()
+        tags = [tag for tag in self._unacked if tag <= delivery_tag] if multiple else [delivery_tag]
+        if requeue:
+            self._requeue(tags)
+        else:
+            tags = self._pop_tags(delivery_tag, multiple)
+            self._dispatch_queues(queue_name for queue_name, _ in tags)
+
+    async def basic_reject(self, delivery_tag, requeue=False):
+        await self.basic_client_nack(delivery_tag, False, requeue)
+
+    def _pop_tags(self, delivery_tag, multiple):
+        """Remove acknowledged delivery tags, a unknown delivery tag closes the channel, the same as RabbitMQ."""
+        if delivery_tag not in self._unacked:
+            self.connection_closed()
+            raise ChannelClosed(406, "PRECONDITION_FAILED - unknown delivery tag {}".format(delivery_tag))
+        if not multiple:
+            return [self._unacked.pop(delivery_tag)]
+        items = []
+        while self._unacked:
+            tag = next(iter(self._unacked))
+            if tag > delivery_tag:
+                break
+            items.append(self._unacked.pop(tag))
+        return items
+
+    def _requeue(self, tags):
+        messages = {}  # e.g. `{queue_name: [message, ...]}`
+        for tag in tags:
+            item = self._unacked.pop(tag, None)
+            if item:
+                messages.setdefault(item[0], []).append(item[1])
+        for queue_name, items in messages.items():
+            self.broker.requeue(queue_name, items)
+
+    def _dispatch_queues(self, queue_names):
+        """Dispatch the queues consumed by this channel, since the prefetch window is open again."""
+        for queue_name in set(queue_names) | {name for name, _, _ in self._consumers.values()}:
+            queue = self.broker._queues.get(queue_name)
+            if queue:
+                self.broker.dispatch(queue)
+
+
+# Default broker shared by all EventCenters in this process.
+broker = MemoryBroker()
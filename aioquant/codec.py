@@ -0,0 +1,386 @@
+# -*- coding:utf-8 -*-
+
+"""
+Event message codecs.
+Every message published by EventCenter is encoded by a codec. The first byte of an encoded message tells which
+codec has been used, so that peers using different codecs can still talk to each other:
+    a) legacy: `json.dumps` + `zlib.compress`, no header byte (a zlib stream always starts with `0x78`);
+    b) others: header byte(codec id, the highest bit is set if the body is compressed by zlib, the second highest bit
+        is set if the meta follows) + [meta] + body.
+
+Meta is an optional envelope extension: publisher origin id(uint32) + sequence number(uint64) + publish time(int64,
+microsecond). In the legacy format it's carried by the extra keys `o` / `q` / `pt` of the JSON object, which are
+ignored by old consumers.
+
+Author: HuangTao
+Date:   2019/11/21
+Email:  huangtao@ifclover.com
+"""
+
+import json
+import time
+import zlib
+import struct
+import itertools
+
+__all__ = ("Codec", "LegacyCodec", "BinaryCodec", "CompressionPolicy", "register_codec", "get_codec", "dumps",
+           "loads", "loads_meta", "peek_meta", )
+
+
+# Registered codecs. e.g. `{"binary": codec}`
+CODECS = {}
+
+# Registered codecs indexed by header byte. e.g. `{0x01: codec}`
+CODEC_IDS = {}
+
+# Header byte flag, set if the message body is compressed by zlib.
+FLAG_ZLIB = 0x80
+
+# Header byte flag, set if the meta follows the header byte.
+FLAG_META = 0x40
+
+# Meta: origin id, sequence number, publish time(microsecond).
+META = struct.Struct("<IQq")
+
+# First byte of a legacy message (zlib stream header).
+LEGACY_HEADER = 0x78
+
+
+class Codec:
+    """Codec base.
+
+    Attributes:
+        codec_id: Codec id written in the header byte, must be less than `0x40`.
+        name: Codec name, used by `RABBITMQ.codec` in config file.
+    """
+
+    codec_id = None
+    name = None
+
+    def encode(self, name, data):
+        """Encode a message.
+
+        Args:
+            name: Event name.
+            data: Event data.
+
+        Returns:
+            b: Encoded body without header byte, or None if this message can not be encoded by this codec.
+        """
+        raise NotImplementedError
+
+    def decode(self, b):
+        """Decode a message.
+
+        Args:
+            b: Encoded body without header byte.
+
+        Returns:
+            name: Event name.
+            data: Event data.
+        """
+        raise NotImplementedError
+
+
+class LegacyCodec(Codec):
+    """JSON codec, the original message format.
+
+    * NOTE:
+        Without a compression policy, the body is always compressed by zlib and sent without header byte, so it's
+        exactly the same as the original message format.
+    """
+
+    codec_id = 0x02
+    name = "json"
+
+    def encode(self, name, data, meta=None):
+        d = {
+            "n": name,
+            "d": data
+        }
+        if meta:
+            d["o"], d["q"], d["pt"] = meta
+        s = json.dumps(d)
+        return s.encode("utf8")
+
+    def decode(self, b):
+        name, data, _ = self.decode_meta(b)
+        return name, data
+
+    def decode_meta(self, b):
+        """Decode a message and the meta carried by the JSON object, meta is None if not found."""
+        d = json.loads(b.decode("utf8"))
+        meta = (d["o"], d["q"], d["pt"]) if "q" in d else None
+        return d.get("n"), d.get("d"), meta
+
+
+class BinaryCodec(Codec):
+    """Compact schema-aware binary codec for Orderbook / Trade / Kline events.
+
+    Body layout:
+        schema id(1 byte) + timestamp(int64) [+ asks count(uint16) + bids count(uint16)] + all string fields joined
+        by `\\x1f` and encoded by utf8, the field keys and JSON punctuation are gone.
+        A trade batch carries the trades count instead of the timestamp, and every trade is `action, price, quantity,
+        timestamp` in the string fields.
+
+    * NOTE:
+        Only string prices / quantities and integer timestamps can be encoded, any other message returns None from
+        `encode` and the caller should fall back to another codec.
+    """
+
+    codec_id = 0x01
+    name = "binary"
+
+    SEP = "\x1f"
+    ORDERBOOK = 1
+    TRADE = 2
+    KLINE = 3
+    TRADE_BATCH = 4
+
+    _orderbook_header = struct.Struct("<BqHH")
+    _header = struct.Struct("<Bq")
+    _trade_keys = ("p", "s", "a", "P", "q")
+    _kline_keys = ("p", "s", "o", "h", "l", "c", "v", "kt")
+
+    def encode(self, name, data):
+        try:
+            if name == "EVENT_ORDERBOOK":
+                asks, bids = data["a"], data["b"]
+                fields = [data["p"], data["s"]]
+                fields.extend(itertools.chain.from_iterable(asks))
+                fields.extend(itertools.chain.from_iterable(bids))
+                if len(fields) != 2 + 2 * (len(asks) + len(bids)):  # Every level must be a `[price, quantity]` pair.
+                    return None
+                header = self._orderbook_header.pack(self.ORDERBOOK, data["t"], len(asks), len(bids))
+            elif name == "EVENT_TRADE":
+                fields = [data[k] for k in self._trade_keys]
+                header = self._header.pack(self.TRADE, data["t"])
+            elif name == "EVENT_KLINE":
+                fields = [data[k] for k in self._kline_keys]
+                header = self._header.pack(self.KLINE, data["t"])
+            elif name == "EVENT_TRADE_BATCH":
+                trades = data["t"]
+                fields = [data["p"], data["s"]]
+                for action, price, quantity, timestamp in trades:
+                    if not isinstance(timestamp, int):
+                        return None
+                    fields.extend((action, price, quantity, str(timestamp)))
+                header = self._header.pack(self.TRADE_BATCH, len(trades))
+            else:
+                return None
+            body = self.SEP.join(fields)
+        except (KeyError, TypeError, ValueError, struct.error):
+            return None
+        if body.count(self.SEP) != len(fields) - 1:
+            return None
+        return header + body.encode("utf8")
+
+    def decode(self, b):
+        schema = b[0]
+        if schema == self.ORDERBOOK:
+            _, timestamp, na, nb = self._orderbook_header.unpack_from(b)
+            fields = b[self._orderbook_header.size:].decode("utf8").split(self.SEP)
+            it = iter(fields[2:2 + 2 * na])
+            asks = list(map(list, zip(it, it)))
+            it = iter(fields[2 + 2 * na:])
+            bids = list(map(list, zip(it, it)))
+            data = {"p": fields[0], "s": fields[1], "a": asks, "b": bids, "t": timestamp}
+            return "EVENT_ORDERBOOK", data
+        _, timestamp = self._header.unpack_from(b)
+        fields = b[self._header.size:].decode("utf8").split(self.SEP)
+        if schema == self.TRADE:
+            data = dict(zip(self._trade_keys, fields))
+            data["t"] = timestamp
+            return "EVENT_TRADE", data
+        if schema == self.KLINE:
+            data = dict(zip(self._kline_keys, fields))
+            data["t"] = timestamp
+            return "EVENT_KLINE", data
+        if schema == self.TRADE_BATCH:
+            it = iter(fields[2:])
+            trades = [[a, p, q, int(t)] for a, p, q, t in zip(it, it, it, it)]
+            return "EVENT_TRADE_BATCH", {"p": fields[0], "s": fields[1], "t": trades}
+        raise ValueError("unknown binary schema: {}".format(schema))
+
+
+class CompressionPolicy:
+    """Size-adaptive compression policy, messages smaller than `threshold` are sent uncompressed.
+
+    Args:
+        threshold: Compress the message body only if it's size is greater than or equal to `threshold` bytes.
+        level: zlib compression level, `1` is the fastest, `9` is the best compression.
+
+    Attributes:
+        stats: Compression statistics, e.g. `{"messages": 10, "compressed": 2, "raw_bytes": 3000, "wire_bytes": 2100,
+            "ratio": 0.7, "time": 0.0001}`, `time` is the seconds spent in compressing.
+    """
+
+    def __init__(self, threshold=256, level=1):
+        """Initialize."""
+        self.threshold = threshold
+        self.level = level
+        self._messages = 0
+        self._compressed = 0
+        self._raw_bytes = 0
+        self._wire_bytes = 0
+        self._time = 0
+
+    @property
+    def stats(self):
+        d = {
+            "messages": self._messages,
+            "compressed": self._compressed,
+            "raw_bytes": self._raw_bytes,
+            "wire_bytes": self._wire_bytes,
+            "ratio": self._wire_bytes / self._raw_bytes if self._raw_bytes else 1,
+            "time": self._time
+        }
+        return d
+
+    def pack(self, codec, body, meta=None):
+        """Pack header byte, meta and (maybe compressed) body.
+
+        Args:
+            codec: Codec which encoded the body.
+            body: Encoded body.
+            meta: Meta `(origin, sequence, publish time)`, default is None.
+
+        Returns:
+            b: Message bytes.
+        """
+        self._messages += 1
+        self._raw_bytes += len(body)
+        if len(body) < self.threshold:
+            b = pack_header(codec.codec_id, meta) + body
+        else:
+            start = time.perf_counter()
+            b = pack_header(codec.codec_id | FLAG_ZLIB, meta) + zlib.compress(body, self.level)
+            self._time += time.perf_counter() - start
+            self._compressed += 1
+        self._wire_bytes += len(b)
+        return b
+
+
+def pack_header(header, meta=None):
+    """Pack header byte and meta."""
+    if not meta:
+        return bytes((header, ))
+    return bytes((header | FLAG_META, )) + META.pack(*meta)
+
+
+def register_codec(codec: Codec):
+    """Register a codec.
+
+    Args:
+        codec: Codec instance, `codec.name` and `codec.codec_id` must be unique.
+
+    * NOTE:
+        `codec.codec_id` must be less than `0x40`, and the header byte can not be `LEGACY_HEADER` with any flags,
+        otherwise the messages could not be decoded.
+    """
+    codec_id = codec.codec_id
+    if codec_id is not None:
+        if not 0 <= codec_id < FLAG_META:
+            raise ValueError("codec id must be less than 0x40: {}".format(codec_id))
+        for flags in (0, FLAG_META, FLAG_ZLIB, FLAG_META | FLAG_ZLIB):
+            if codec_id | flags == LEGACY_HEADER:
+                raise ValueError("codec id conflicts with the legacy header: {}".format(codec_id))
+        if codec_id in CODEC_IDS:
+            raise ValueError("codec id already registered: {}".format(codec_id))
+    CODECS[codec.name] = codec
+    if codec_id is not None:
+        CODEC_IDS[codec_id] = codec
+
+
+def get_codec(name=None):
+    """Get a registered codec by name, default is the legacy codec."""
+    return CODECS.get(name) or LEGACY_CODEC
+
+
+def dumps(name, data, codec=None, policy: CompressionPolicy = None, meta=None):
+    """Encode a message.
+
+    Args:
+        name: Event name.
+        data: Event data.
+        codec: Codec name, default is the legacy codec. If the codec can not encode this message, the legacy codec
+            will be used instead.
+        policy: Compression policy, default is None. Without a policy, the legacy codec compresses every message
+            (the original message format) and the other codecs never compress.
+        meta: Meta `(origin, sequence, publish time)`, default is None.
+
+    Returns:
+        b: Encoded bytes.
+    """
+    c = get_codec(codec)
+    body = None if c is LEGACY_CODEC else c.encode(name, data)
+    if body is None:
+        c = LEGACY_CODEC
+        if not policy:
+            return zlib.compress(c.encode(name, data, meta))
+        body = c.encode(name, data)
+    if policy:
+        return policy.pack(c, body, meta)
+    return pack_header(c.codec_id, meta) + body
+
+
+def loads(b):
+    """Decode a message encoded by any registered codec.
+
+    Args:
+        b: Encoded bytes.
+
+    Returns:
+        name: Event name.
+        data: Event data.
+    """
+    name, data, _ = loads_meta(b)
+    return name, data
+
+
+def loads_meta(b):
+    """Decode a message encoded by any registered codec, and the meta.
+
+    Args:
+        b: Encoded bytes.
+
+    Returns:
+        name: Event name.
+        data: Event data.
+        meta: Meta `(origin, sequence, publish time)`, None if the publisher didn't send it.
+    """
+    header = b[0]
+    if header == LEGACY_HEADER:
+        return LEGACY_CODEC.decode_meta(zlib.decompress(b))
+    codec = CODEC_IDS[header & ~(FLAG_ZLIB | FLAG_META)]
+    start = 1
+    meta = None
+    if header & FLAG_META:
+        meta = META.unpack_from(b, 1)
+        start += META.size
+    if header & FLAG_ZLIB:
+        body = zlib.decompress(memoryview(b)[start:])
+    else:
+        body = b[start:]
+    name, data = codec.decode(body)
+    return name, data, meta
+
+
+def peek_meta(b):
+    """Get the meta of a message without decoding it.
+
+    Args:
+        b: Encoded bytes.
+
+    Returns:
+        meta: Meta `(origin, sequence, publish time)`, None if the message has no meta, or it's in the legacy format
+            (the meta is inside the compressed JSON object, use `loads_meta` instead).
+    """
+    if b[0] != LEGACY_HEADER and b[0] & FLAG_META:
+        return META.unpack_from(b, 1)
+    return None
+
+
+LEGACY_CODEC = LegacyCodec()
+register_codec(LEGACY_CODEC)
+register_codec(BinaryCodec())
@@ -8,20 +8,30 @@ Date:   2018/05/04
 Email:  huangtao@ifclover.com
 """
 
-import json
-import zlib
+import os
+import time
+import bisect
+import random
 import asyncio
+import functools
+from collections import deque, OrderedDict
 
 import aioamqp
+from aioamqp.protocol import OPEN
 
+from aioquant import codec
+from aioquant.broker import broker
+from aioquant.codec import CompressionPolicy
+from aioquant.utils import tools
 from aioquant.utils import logger
 from aioquant.configure import config
 from aioquant.tasks import LoopRunTask, SingleTask
 from aioquant.market import Orderbook, Trade, Kline
 from aioquant.utils.decorator import async_method_locker
+from aioquant.utils.ringbuffer import RingBufferWriter, RingBufferReader
 
 
-__all__ = ("EventCenter", "EventKline", "EventOrderbook", "EventTrade", )
+__all__ = ("EventCenter", "EventKline", "EventOrderbook", "EventOrderbookDelta", "EventTrade", "EventTradeBatch", )
 
 
 class Event:
@@ -34,6 +44,8 @@ class Event:
         routing_key: Routing key name.
         pre_fetch_count: How may message per fetched, default is `1`.
         data: Message content.
+        meta: Envelope meta `(origin, sequence, publish time)` set by the publisher's event center, origin is a random
+            id of the publisher, sequence is monotonic per `(exchange, routing_key)`, publish time is in microsecond.
     """
 
     def __init__(self, name=None, exchange=None, queue=None, routing_key=None, pre_fetch_count=1, data=None):
@@ -44,6 +56,7 @@ class Event:
         self._routing_key = routing_key
         self._pre_fetch_count = pre_fetch_count
         self._data = data
+        self._meta = None
         self._callback = None  # Asynchronous callback function.
 
     @property
@@ -70,40 +83,81 @@ class Event:
     def data(self):
         return self._data
 
-    def dumps(self):
+    @property
+    def meta(self):
+        return self._meta
+
+    @meta.setter
+    def meta(self, meta):
+        self._meta = meta
+
+    def dumps(self, codec_name=None, policy=None):
+        """Encode this event.
+
+        Args:
+            codec_name: Codec name, e.g. `json` / `binary`, default is the legacy `json` codec.
+            policy: Compression policy, default is None.
+        """
+        b = codec.dumps(self.name, self.data, codec_name, policy, self._meta)
+        return b
+
+    def loads(self, b):
+        """Decode a message encoded by any registered codec."""
+        self._name, self._data, self._meta = codec.loads_meta(b)
         d = {
             "n": self.name,
             "d": self.data
         }
-        s = json.dumps(d)
-        b = zlib.compress(s.encode("utf8"))
-        return b
-
-    def loads(self, b):
-        b = zlib.decompress(b)
-        d = json.loads(b.decode("utf8"))
-        self._name = d.get("n")
-        self._data = d.get("d")
         return d
 
     def parse(self):
         raise NotImplemented
 
-    def subscribe(self, callback, multi=False):
+    def parse_all(self):
+        """Parse the decoded message into market objects belong to this event, a batch message carries many."""
+        o = self.parse()
+        return [o] if self.accept(o) else []
+
+    @property
+    def bindings(self):
+        """Routing keys the subscriber's queue is bound with."""
+        return [self.routing_key]
+
+    def accept(self, o):
+        """If a market object received by the subscriber's queue belongs to this event."""
+        return True
+
+    def match(self, routing_key):
+        """If a message with this routing key belongs to this event, checked before decoding for the subscribers with
+        wildcard routing key."""
+        return True
+
+    def subscribe(self, callback, multi=False, conflate=False, batch=False):
         """Subscribe a event.
 
         Args:
             callback: Asynchronous callback function.
             multi: If subscribe multiple channels?
+            conflate: If only keep the newest unprocessed message per routing key when the callback is busy?
+            batch: If True, the callback receives a list of the market objects carried by a message.
         """
         from aioquant import quant
         self._callback = callback
-        SingleTask.run(quant.event_center.subscribe, self, self.callback, multi)
+        SingleTask.run(quant.event_center.subscribe, self, callback, multi, conflate, batch)
+
+    def unsubscribe(self):
+        """Unsubscribe all subscriptions of this event, it's safe to be called right after `subscribe`."""
+        from aioquant import quant
+        SingleTask.run(quant.event_center.unsubscribe, self)
 
     def publish(self):
-        """Publish a event."""
+        """Publish a event.
+
+        Returns:
+            future: Publisher confirm future if `confirm` is enabled for this exchange, otherwise None.
+        """
         from aioquant import quant
-        SingleTask.run(quant.event_center.publish, self)
+        return quant.event_center.publish_nowait(self)
 
     async def callback(self, channel, body, envelope, properties):
         self._exchange = envelope.exchange_name
@@ -130,44 +184,203 @@ class EventKline(Event):
     * NOTE:
         Publisher: Market server.
         Subscriber: Any servers.
+        The routing key is `{platform}.{symbol}.{kline_type}`, so that the subscribers only receive the klines of the
+        type they subscribed. Legacy publishers publish all klines with routing key `{platform}.{symbol}`, so the
+        subscriber's queue is bound with the legacy routing key as well, and the klines of other types are dropped.
+        The legacy routing key is not bound if the platform or symbol is a wildcard (`*` or `#`), since it would
+        receive the klines of all types.
     """
 
     def __init__(self, kline: Kline):
         """Initialize."""
         name = "EVENT_KLINE"
         exchange = "Kline"
-        routing_key = "{p}.{s}".format(p=kline.platform, s=kline.symbol)
+        self._kline_type = kline.kline_type
+        self._legacy_routing_key = "{p}.{s}".format(p=kline.platform, s=kline.symbol)
+        if kline.kline_type:
+            routing_key = "{p}.{s}.{kt}".format(p=kline.platform, s=kline.symbol, kt=kline.kline_type)
+        else:
+            routing_key = self._legacy_routing_key
         queue = "{sid}.{ex}.{rk}".format(sid=config.server_id, ex=exchange, rk=routing_key)
         super(EventKline, self).__init__(name, exchange, queue, routing_key, data=kline.smart)
 
     def parse(self):
-        kline = Kline().load_smart(self.data)
+        kline = Kline.from_smart(self.data)
         return kline
 
+    @property
+    def bindings(self):
+        if self._kline_type and not any(c in self._legacy_routing_key for c in "*#"):
+            return [self.routing_key, self._legacy_routing_key]
+        return [self.routing_key]
+
+    def accept(self, kline):
+        return not self._kline_type or kline.kline_type == self._kline_type
+
+    def match(self, routing_key):
+        if not self._kline_type:
+            return True
+        words = routing_key.split(".")
+        return len(words) == 2 or words[-1] == self._kline_type  # Legacy klines are checked by `accept`.
+
 
 class EventOrderbook(Event):
     """Orderbook event.
 
     Attributes:
         orderbook: Orderbook object.
+        depth: How many levels needed, default is None (full orderbook). The smallest depth tier (`depth_tiers` in
+            `Orderbook` exchange options) covering it is used, the orderbook is truncated to the tier's levels and
+            it's routing key is `{platform}.{symbol}.d{tier}`. If no tier covers it, the full orderbook is used.
 
     * NOTE:
-        Publisher: Market server.
-        Subscriber: Any servers.
+        Publisher: Market server. If `depth_tiers` is set, the event center publishes every full orderbook and it's
+            depth tiers.
+        Subscriber: Any servers. The orderbook delta messages (`EventOrderbookDelta`) are applied to the orderbook
+            rebuilt per platform and symbol, and the rebuilt orderbook is delivered.
     """
 
-    def __init__(self, orderbook: Orderbook):
+    def __init__(self, orderbook: Orderbook, depth=None):
         """Initialize."""
         name = "EVENT_ORDERBOOK"
         exchange = "Orderbook"
+        self._tier = self.get_tier(depth)
         routing_key = "{p}.{s}".format(p=orderbook.platform, s=orderbook.symbol)
+        data = orderbook.smart
+        if self._tier:
+            routing_key += ".d{}".format(self._tier)
+            if data["a"] is not None:
+                data["a"] = data["a"][:self._tier]
+                data["b"] = data["b"][:self._tier]
         queue = "{sid}.{ex}.{rk}".format(sid=config.server_id, ex=exchange, rk=routing_key)
-        super(EventOrderbook, self).__init__(name, exchange, queue, routing_key, data=orderbook.smart)
+        super(EventOrderbook, self).__init__(name, exchange, queue, routing_key, data=data)
+        self._books = {}  # Orderbooks rebuilt from delta messages, e.g. `{(platform, symbol): DeltaBook}`
+
+    @property
+    def tier(self):
+        return self._tier
+
+    @staticmethod
+    def get_tier(depth):
+        """Get the smallest depth tier covering `depth` levels, None if no tier covers it."""
+        if not depth:
+            return None
+        options = (config.rabbitmq or {}).get("exchanges", {}).get("Orderbook", {})
+        tiers = [tier for tier in options.get("depth_tiers", []) if tier >= depth]
+        return min(tiers) if tiers else None
 
     def parse(self):
-        orderbook = Orderbook().load_smart(self.data)
+        orderbook = Orderbook.from_smart(self.data)
         return orderbook
 
+    def parse_all(self):
+        if self.name == EventOrderbookDelta.NAME:
+            key = (self.data["p"], self.data["s"])
+            book = self._books.get(key)
+            if book is None:
+                book = self._books[key] = DeltaBook()
+            orderbook = book.apply(self.data)
+            return [orderbook] if orderbook else []
+        return [self.parse()]
+
+    def match(self, routing_key):
+        last = routing_key.rsplit(".", 1)[-1]
+        if self._tier:
+            return last == "d{}".format(self._tier)
+        return not (last[:1] == "d" and last[1:].isdigit())
+
+
+class EventOrderbookDelta(Event):
+    """Orderbook delta event, only the levels changed since the previous orderbook of the same routing key, or a full
+    orderbook (keyframe) periodically.
+
+    Attributes:
+        event: The orderbook event this delta is made from, it's routing key and meta are used.
+        seq: Delta sequence number, monotonic per routing key.
+        keyframe: If True, `asks` and `bids` are the full orderbook.
+        asks: Changed asks, e.g. `[[price, quantity], ...]`, quantity is None if the level is removed.
+        bids: Changed bids, same as `asks`.
+
+    * NOTE:
+        Publisher: Market server. If `delta_keyframe_interval` is set in `Orderbook` exchange options, the event
+            center publishes `EventOrderbook` as `EventOrderbookDelta`, every `delta_keyframe_interval` messages is a
+            keyframe.
+        Subscriber: Any servers, by subscribing `EventOrderbook`.
+        It's published with the same routing key as `EventOrderbook`, so all subscribers must be upgraded before
+        deltas are enabled.
+    """
+
+    NAME = "EVENT_ORDERBOOK_DELTA"
+
+    def __init__(self, event: EventOrderbook, seq, keyframe, asks, bids):
+        """Initialize."""
+        data = {
+            "p": event.data["p"],
+            "s": event.data["s"],
+            "t": event.data["t"],
+            "q": seq,
+            "k": keyframe,
+            "a": asks,
+            "b": bids
+        }
+        super(EventOrderbookDelta, self).__init__(self.NAME, event.exchange, event.queue, event.routing_key, data=data)
+        self.meta = event.meta
+
+    def parse(self):
+        """Delta payload, e.g. `{"p": platform, "s": symbol, "t": timestamp, "q": seq, "k": keyframe, "a": asks,
+        "b": bids}`. A delta is not a orderbook by itself, the subscribers receive the orderbook rebuilt from deltas
+        by `EventOrderbook.parse_all`."""
+        return self.data
+
+
+class DeltaBook:
+    """Orderbook rebuilt from orderbook delta messages of a routing key.
+
+    Attributes:
+        synced: If the orderbook is in sync with the publisher's.
+        resyncs: How many times a gap is found and the orderbook waits for the next keyframe.
+    """
+
+    def __init__(self):
+        """Initialize."""
+        self._seq = None  # The last delta sequence number applied.
+        self._asks = {}  # e.g. `{price: (float price, quantity)}`
+        self._bids = {}
+        self.synced = False
+        self.resyncs = 0
+
+    def apply(self, data):
+        """Apply a delta message.
+
+        Args:
+            data: Delta message data.
+
+        Returns:
+            orderbook: The rebuilt orderbook, or None if waiting for a keyframe.
+        """
+        seq = data["q"]
+        if data["k"]:
+            self._asks = {}
+            self._bids = {}
+            self.synced = True
+        elif not self.synced or seq != self._seq + 1:
+            if self.synced:
+                self.synced = False
+                self.resyncs += 1
+                logger.warn("orderbook delta gap, wait for the next keyframe. symbol:", data["s"], "seq:", seq,
+                            "expect:", self._seq + 1, caller=self)
+            return None
+        self._seq = seq
+        for levels, side in ((data["a"], self._asks), (data["b"], self._bids)):
+            for price, quantity in levels:
+                if quantity is None:
+                    side.pop(price, None)
+                else:
+                    side[price] = (float(price), quantity)
+        asks = [[price, quantity] for price, (_, quantity) in sorted(self._asks.items(), key=lambda x: x[1][0])]
+        bids = [[price, quantity] for price, (_, quantity) in sorted(self._bids.items(), key=lambda x: -x[1][0])]
+        return Orderbook(data["p"], data["s"], asks, bids, data["t"])
+
 
 class EventTrade(Event):
     """Trade event.
@@ -189,55 +402,868 @@ class EventTrade(Event):
         super(EventTrade, self).__init__(name, exchange, queue, routing_key, data=trade.smart)
 
     def parse(self):
-        trade = Trade().load_smart(self.data)
+        trade = Trade.from_smart(self.data)
         return trade
 
+    def parse_all(self):
+        if self.name == EventTradeBatch.NAME:
+            return EventTradeBatch.load_trades(self.data)
+        return [self.parse()]
+
+
+class EventTradeBatch(Event):
+    """Trade batch event, a batch of trades of the same platform and symbol in one message.
+
+    Attributes:
+        trades: Trade object list.
+
+    * NOTE:
+        Publisher: Market server. If `batch_window` is set in `Trade` exchange options, the event center packs the
+            `EventTrade` of a routing key published within the window into one `EventTradeBatch`.
+        Subscriber: Any servers, by subscribing `EventTrade`, every trade in the batch is delivered to the callback.
+        It's published to the `Trade` exchange with the same routing key as `EventTrade`, so all subscribers must be
+        upgraded before batching is enabled.
+    """
+
+    NAME = "EVENT_TRADE_BATCH"
+
+    def __init__(self, trades):
+        """Initialize."""
+        name = self.NAME
+        exchange = "Trade"
+        platform, symbol = trades[0].platform, trades[0].symbol
+        routing_key = "{p}.{s}".format(p=platform, s=symbol)
+        queue = "{sid}.{ex}.{rk}".format(sid=config.server_id, ex=exchange, rk=routing_key)
+        data = {
+            "p": platform,
+            "s": symbol,
+            "t": [[trade.action, trade.price, trade.quantity, trade.timestamp] for trade in trades]
+        }
+        super(EventTradeBatch, self).__init__(name, exchange, queue, routing_key, data=data)
+
+    @staticmethod
+    def load_trades(data):
+        """Load trade object list from the batch data."""
+        platform, symbol = data["p"], data["s"]
+        trades = [Trade(platform, symbol, *item) for item in data["t"]]
+        return trades
+
+    def parse(self):
+        return self.load_trades(self.data)
+
+    def parse_all(self):
+        return self.parse()
+
+
+class LatencyHistogram:
+    """Latency histogram with fixed buckets.
+
+    Attributes:
+        stats: e.g. `{"count": 100, "mean": 520, "max": 3000, "p50": 500, "p99": 2500, "buckets": {"100": 10, ...,
+            "inf": 0}}`, all in microsecond, a bucket counts the latencies less than or equal to it's bound and
+            greater than the previous bound, `p50` / `p99` are the bounds of the buckets they fall into, 0 if no
+            latency.
+    """
+
+    BOUNDS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000, 5000000)
+
+    def __init__(self):
+        """Initialize."""
+        self._counts = [0] * (len(self.BOUNDS) + 1)
+        self._count = 0
+        self._sum = 0
+        self._max = 0
+
+    def add(self, latency):
+        """Add a latency(microsecond), negative latency (clock skew between hosts) is counted in the first bucket."""
+        self._counts[bisect.bisect_left(self.BOUNDS, latency)] += 1
+        self._count += 1
+        self._sum += latency
+        if latency > self._max:
+            self._max = latency
+
+    def percentile(self, p):
+        """Upper bound of the bucket which the `p`(0~1) percentile falls into, None if infinite, 0 if no latency.
+
+        >>> h = LatencyHistogram()
+        >>> h.percentile(0.5)
+        0
+        >>> h.add(300)
+        >>> h.percentile(0.5)
+        500
+        """
+        if not self._count:
+            return 0
+        target = self._count * p
+        total = 0
+        for bound, count in zip(self.BOUNDS, self._counts):
+            total += count
+            if total >= target:
+                return bound
+        return None
+
+    @property
+    def stats(self):
+        d = {
+            "count": self._count,
+            "mean": self._sum / self._count if self._count else 0,
+            "max": self._max,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "buckets": dict(zip([str(bound) for bound in self.BOUNDS] + ["inf"], self._counts))
+        }
+        return d
+
+
+class Subscription:
+    """Event subscription, deliver parsed market objects to the subscriber's callback.
+
+    Args:
+        event: Subscribed event.
+        callback: Asynchronous callback function.
+        multi: If subscribe multiple channels(routing keys)?
+        conflate: If True, at most one callback is running at a time, and only the newest unprocessed object per
+            routing key is kept while the callback is running, the older ones are skipped.
+        batch: If True, the callback receives a list of the market objects carried by a message (e.g. a trade batch),
+            otherwise the callback receives the market objects one by one.
+
+    Attributes:
+        received: How many messages received, a batch message is counted once.
+        first_event: Timestamp(second) of the first message received, None if nothing received yet.
+        active: False if unsubscribed, the objects received after that are not delivered.
+        skipped: How many objects skipped by conflation.
+        expired: How many messages dropped because they are older than `max_age` in exchange options.
+        gaps: How many messages missing according to the sequence numbers, a message arrived late is not missing.
+        duplicates: How many messages received more than once.
+        reorders: How many messages arrived later than a message with bigger sequence number.
+        latency: Publish -> receive latency histogram, in microsecond.
+
+    * NOTE:
+        Sequence numbers are tracked per publisher and routing key, messages without meta (legacy publishers) are
+        not tracked.
+    """
+
+    MAX_MISSING = 1000  # Max missing sequence numbers remembered per publisher and routing key.
+
+    def __init__(self, event: Event, callback, multi=False, conflate=False, batch=False):
+        """Initialize."""
+        self.event = event
+        self.callback = callback
+        self.multi = multi
+        self.conflate = conflate
+        self.batch = batch
+        self.active = True
+        self.received = 0
+        self.first_event = None
+        self.skipped = 0
+        self.expired = 0
+        self.gaps = 0
+        self.duplicates = 0
+        self.reorders = 0
+        self.latency = LatencyHistogram()
+        self._running = False  # If the callback is running, only used by conflation.
+        self._pending = {}  # The newest unprocessed object per routing key, e.g. `{routing_key: object}`
+        self._sequences = {}  # The biggest sequence number received, e.g. `{(origin, routing_key): 100}`
+        self._missing = {}  # Missing sequence numbers, e.g. `{(origin, routing_key): {98, 99}}`
+
+    @property
+    def stats(self):
+        d = {
+            "exchange": self.event.exchange,
+            "routing_key": self.event.routing_key,
+            "received": self.received,
+            "skipped": self.skipped,
+            "expired": self.expired,
+            "gaps": self.gaps,
+            "duplicates": self.duplicates,
+            "reorders": self.reorders,
+            "latency": self.latency.stats
+        }
+        return d
+
+    def track(self, meta, routing_key):
+        """Track a received message, it's sequence number and latency.
+
+        Args:
+            meta: Envelope meta `(origin, sequence, publish time)`, or None.
+            routing_key: Routing key of the message.
+        """
+        self.received += 1
+        if self.first_event is None:
+            self.first_event = time.time()
+        if not meta:
+            return
+        origin, seq, publish_time = meta
+        self.latency.add(tools.get_cur_timestamp_us() - publish_time)
+        key = (origin, routing_key)
+        last = self._sequences.get(key)
+        if last is None or seq > last:
+            if last is not None and seq > last + 1:
+                self.gaps += seq - last - 1
+                missing = self._missing.setdefault(key, set())
+                if len(missing) < self.MAX_MISSING:
+                    missing.update(range(last + 1, min(seq, last + 1 + self.MAX_MISSING - len(missing))))
+            self._sequences[key] = seq
+        elif seq in self._missing.get(key, ()):
+            self._missing[key].discard(seq)
+            self.gaps -= 1
+            self.reorders += 1
+        else:
+            self.duplicates += 1
+
+    def dispatch(self, objects, routing_key):
+        """Deliver the market objects parsed from a message.
+
+        Args:
+            objects: Market object list.
+            routing_key: Routing key of the message.
+        """
+        if not self.active:
+            return
+        if self.batch:
+            self.deliver(objects, routing_key)
+            return
+        for o in objects:
+            self.deliver(o, routing_key)
+
+    async def run(self, objects):
+        """Run the callback with the market objects parsed from a message and wait for it."""
+        if not self.active:
+            return
+        if self.batch:
+            await self.callback(objects)
+            return
+        for o in objects:
+            if not self.active:
+                break
+            await self.callback(o)
+
+    def deliver(self, o, routing_key):
+        """Deliver a market object.
+
+        Args:
+            o: Market object.
+            routing_key: Routing key of the message.
+        """
+        if not self.conflate:
+            SingleTask.run(self.callback, o)
+            return
+        if self._running:
+            if routing_key in self._pending:
+                self.skipped += 1
+            self._pending[routing_key] = o
+            return
+        self._running = True
+        SingleTask.run(self._run_conflated, o)
+
+    async def _run_conflated(self, o):
+        try:
+            while True:
+                try:
+                    await self.callback(o)
+                except Exception as e:
+                    logger.exception("callback error:", e, caller=self)
+                if not self._pending or not self.active:
+                    break
+                o = self._pending.pop(next(iter(self._pending)))
+        finally:
+            self._running = False
+
 
 class EventCenter:
     """Event center.
+
+    * NOTE:
+        If `RABBITMQ` is not configured, event center works in process only, events are delivered to the subscribers
+        in the same process directly.
+        If `RABBITMQ.in_process` is `true`, events published by this process are delivered to the subscribers in this
+        process directly (without encoding and RabbitMQ), and also published to RabbitMQ for other processes.
+        If `shm` is enabled in exchange options, events are written into a shared memory ring buffer per routing key
+        as well, and the subscribers on the same host (without wildcard routing key) read them from the ring buffer
+        instead of RabbitMQ, as long as the writer is alive (it's heartbeat is updated in `shm_timeout` seconds),
+        otherwise they consume from RabbitMQ, e.g. the publisher runs on another host.
+        If `RABBITMQ.transport` is `memory`, the in-memory broker (`aioquant.broker`) is used instead of RabbitMQ,
+        for tests and benchmarks.
+        Subscriptions are bound to RabbitMQ once `ready` is called (by `quant.start` after the entrance function
+        finished), and the subscriptions made after that are bound immediately. If `ready` is not called, binding
+        starts 5 seconds after connected.
     """
 
     def __init__(self):
-        self._host = config.rabbitmq.get("host", "localhost")
-        self._port = config.rabbitmq.get("port", 5672)
-        self._username = config.rabbitmq.get("username", "guest")
-        self._password = config.rabbitmq.get("password", "guest")
-        self._protocol = None
-        self._channel = None  # Connection channel.
+        options = config.rabbitmq or {}
+        self._amqp = bool(config.rabbitmq)  # If RabbitMQ is configured.
+        self._in_process = not self._amqp or options.get("in_process", False)  # If deliver events in process.
+        self._app_id = tools.get_uuid1()  # Mark the events published by this process.
+        self._origin = random.getrandbits(32)  # Publisher id in envelope meta.
+        self._sequences = {}  # The last sequence number published, e.g. `{(exchange, routing_key): 100}`
+        self._host = options.get("host", "localhost")
+        self._port = options.get("port", 5672)
+        self._username = options.get("username", "guest")
+        self._password = options.get("password", "guest")
+        self._transport = options.get("transport", "amqp")  # `amqp`: RabbitMQ / `memory`: in-memory broker.
+        self._codec = options.get("codec", "json")  # Codec name for publishing, `json` / `binary`.
+        self._exchanges = options.get("exchanges", {})  # Options per exchange, e.g. `{"Orderbook": {...}}`
+        self._compression = {}  # Compression policy per exchange, e.g. `{"Orderbook": policy}`
+        for name, item in self._exchanges.items():
+            if "compress_threshold" in item or "compress_level" in item:
+                policy = CompressionPolicy(item.get("compress_threshold", 256), item.get("compress_level", 1))
+                self._compression[name] = policy
+        self._publish_batch_size = options.get("publish_batch_size", 100)  # Max events per queue per round.
+        self._publish_queues = {}  # Publish queue per exchange, e.g. `{"Orderbook": deque([event, ...])}`
+        self._publish_counters = {}  # e.g. `{"Orderbook": {"published": 100, "dropped": 2}}`
+        self._publish_waiter = asyncio.Event()  # Set when there are events waiting to be published.
+        self._delta_states = {}  # Orderbooks published last, e.g. `{routing_key: (delta seq, asks, bids)}`
+        self._trade_batches = {}  # Trade batches, e.g. `{(exchange, routing_key): ([event, ...], future, handle)}`
+        self._properties = {"app_id": self._app_id} if self._in_process else None  # Publish message properties.
+        self._confirm_window = options.get("confirm_window", 100)  # Max events waiting for publisher confirms.
+        self._confirm_channel = None  # Channel in confirm mode, for exchanges with `confirm` enabled.
+        self._confirm_tag = 0  # Delivery tag of the last event published by the confirm channel.
+        self._unconfirmed = OrderedDict()  # Events waiting for confirmation, e.g. `{tag: (exchange, event, future)}`
+        self._publish_channel_count = options.get("publish_channels", 1)  # How many channels for publishing.
+        self._separate_connections = options.get("separate_connections", False)  # If publish / consume use 2 TCPs.
+        self._protocols = []  # AMQP connections, publish connection first.
+        self._publish_channels = []  # Channels for publishing.
+        self._consume_channels = {}  # Channels for consuming per exchange, e.g. `{"Orderbook": channel}`
+        self._channel_locks = {}  # Serialize the RPCs of a consume channel, e.g. `{channel: asyncio.Lock()}`
         self._connected = False  # If connect success.
-        self._subscribers = []  # e.g. `[(event, callback, multi), ...]`
-        self._event_handler = {}  # e.g. `{"exchange:routing_key": [callback_function, ...]}`
+        self._heartbeat = options.get("heartbeat")  # AMQP heartbeat interval(second), default is aioamqp's.
+        self._reconnect_delay = options.get("reconnect_delay", 0.5)  # First reconnect delay(second).
+        self._reconnect_max_delay = options.get("reconnect_max_delay", 30)  # Max reconnect delay(second).
+        self._reconnecting = False  # If the reconnect loop is running.
+        self._lost_while_reconnecting = False  # If a connection lost is reported while the reconnect loop is running.
+        self._reopening = set()  # Channels closed by channel errors and being reopened.
+        self._channel_failures = {}  # Channel errors for reopen backoff, e.g. `{"Orderbook": (attempt, timestamp)}`
+        self._generation = 0  # Increased when connections closed, channel watchers of old connections are ignored.
+        self._reconnects = 0  # How many times reconnected.
+        self._downtime = 0  # Total seconds disconnected.
+        self._last_downtime = 0  # Seconds disconnected last time.
+        self._ready = False  # If all modules are initialized, subscriptions are bound after ready.
+        self._bound = set()  # Subscriptions bound on the current connection.
+        self._consumed = set()  # Routing keys consumed on the current connection, e.g. `{(exchange, routing_key)}`
+        self._consumers = {}  # Consumers on the current connection, key is `(exchange, routing_key)` or a multi
+                              # subscription, e.g. `{key: (channel, consumer_tag, queue_name)}`
+        self._created = time.time()  # Timestamp of creation, startup times are relative to it.
+        self._startup = {}  # Startup times(second), e.g. `{"connected": 0.01, "ready": 0.02, "bound": 0.03}`
+        self._subscribers = []  # e.g. `[subscription, ...]`
+        self._event_handler = {}  # Kept across reconnects, e.g. `{(exchange, routing_key): (event, [subscription])}`
+        self._local_handlers = {}  # e.g. `{"Orderbook": [subscription, ...]}`
+        self._local_routes = {}  # Matched handlers, e.g. `{("Orderbook", "binance.ETH/BTC"): [subscription, ...]}`
+        self._acks = {}  # Pending batched acknowledgements per channel, e.g. `{channel: {"tag": 10, "count": 5, ...}}`
+        self._shm_path = options.get("shm_path", "/dev/shm/aioquant")  # Shared memory ring buffer directory.
+        self._shm_poll_interval = options.get("shm_poll_interval", 1) / 1000  # Ring buffer poll interval(second).
+        self._shm_writers = {}  # e.g. `{(exchange, routing_key): writer}`
+        self._shm_readers = {}  # e.g. `{(exchange, routing_key): (reader, event, [subscription, ...])}`
+        self._shm_polling = False  # If the ring buffer poller is running.
+        self._shm_timeout = options.get("shm_timeout", 3)  # Seconds without writer heartbeat to use RabbitMQ instead.
+        self._shm_fallback = set()  # Routing keys consumed from RabbitMQ since no writer is alive, `{(exchange, rk)}`
+
+        if not self._amqp:
+            return
 
         # Register a loop run task to check TCP connection's healthy.
         LoopRunTask.register(self._check_connection, 10)
 
-        # Create MQ connection.
-        asyncio.get_event_loop().run_until_complete(self.connect())
+        # Create MQ connection, don't block if the event loop is running already (e.g. created in a coroutine).
+        loop = asyncio.get_event_loop()
+        if loop.is_running():
+            SingleTask.run(self.connect)
+        else:
+            loop.run_until_complete(self.connect())
+
+        # Start the publish writer.
+        SingleTask.run(self._publish_writer)
+
+    @property
+    def stats(self):
+        """Running statistics.
+
+        e.g. `{"compression": {"Orderbook": {"messages": 10, "ratio": 0.5, ...}},
+               "publish": {"Orderbook": {"depth": 0, "published": 100, "dropped": 2, "batched": 0}},
+               "subscriptions": [{"exchange": "Orderbook", "routing_key": "binance.ETH/BTC", "skipped": 0, "gaps": 0,
+                                  "duplicates": 0, "reorders": 0, "latency": {"count": 100, ...}}, ...],
+               "shm": {"writers": {"Orderbook:binance.ETH/BTC": {"written": 100, "oversize": 0}},
+                       "readers": {"Orderbook:binance.ETH/BTC": {"received": 100, "overruns": 0}}},
+               "startup": {"connected": 0.01, "ready": 0.02, "bound": 0.03, "first_event": 0.05},
+               "connection": {"connected": True, "reconnects": 1, "downtime": 1.5, "last_downtime": 1.5}}`
+
+            Startup times are seconds since the event center was created: `connected` is the first connection made,
+            `ready` is all modules initialized, `bound` is all subscriptions made before ready are bound, and
+            `first_event` is the first message received by any subscription (time to first event).
+        """
+        publish = {}
+        for name, counter in self._publish_counters.items():
+            publish[name] = dict(counter, depth=len(self._publish_queues[name]))
+        d = {
+            "compression": {name: policy.stats for name, policy in self._compression.items()},
+            "publish": publish,
+            "subscriptions": [subscription.stats for subscription in self._subscribers],
+            "shm": {
+                "writers": {"{}:{}".format(*key): {"written": writer.written, "oversize": writer.oversize}
+                            for key, writer in self._shm_writers.items()},
+                "readers": {"{}:{}".format(*key): {"received": reader.received, "overruns": reader.overruns}
+                            for key, (reader, _, _) in self._shm_readers.items()}
+            },
+            "startup": dict(self._startup),
+            "connection": {
+                "connected": self._connected,
+                "reconnects": self._reconnects,
+                "downtime": self._downtime,
+                "last_downtime": self._last_downtime
+            }
+        }
+        first_events = [subscription.first_event for subscription in self._subscribers if subscription.first_event]
+        if first_events:
+            d["startup"]["first_event"] = min(first_events) - self._created
+        return d
 
     @async_method_locker("EventCenter.subscribe")
-    async def subscribe(self, event: Event, callback=None, multi=False):
+    async def subscribe(self, event: Event, callback=None, multi=False, conflate=False, batch=False):
         """Subscribe a event.
 
         Args:
             event: Event type.
             callback: Asynchronous callback.
             multi: If subscribe multiple channel(routing_key) ?
+            conflate: If only keep the newest unprocessed message per routing key when the callback is busy?
+            batch: If True, the callback receives a list of the market objects carried by a message.
+
+        Returns:
+            subscription: Subscription object.
         """
         logger.info("NAME:", event.name, "EXCHANGE:", event.exchange, "QUEUE:", event.queue, "ROUTING_KEY:",
                     event.routing_key, caller=self)
-        self._subscribers.append((event, callback, multi))
+        subscription = Subscription(event, callback, multi, conflate, batch)
+        self._subscribers.append(subscription)
+        if callback and not multi:
+            self._add_event_handler(subscription)
+        if self._in_process and callback:
+            self._local_handlers.setdefault(event.exchange, []).append(subscription)
+            self._local_routes = {}
+        if self._shm_enabled(event.exchange) and callback and not multi:
+            self._add_shm_reader(subscription)
+        if self._ready and self._connected:
+            SingleTask.run(self._initialize, subscription)
+        return subscription
+
+    @async_method_locker("EventCenter.subscribe")
+    async def unsubscribe(self, target):
+        """Unsubscribe, the subscription's callback will not be called any more.
+
+        Args:
+            target: Subscription object returned by `subscribe`, or a event object (all subscriptions of this event
+                object are cancelled).
+
+        Returns:
+            count: How many subscriptions cancelled.
+
+        * NOTE:
+            The consumer of a queue is cancelled after all subscriptions sharing it are cancelled. A queue with a name
+            is declared with `auto_delete`, so RabbitMQ deletes it (and it's bindings) after it's last consumer
+            cancelled, other processes with the same server id may still be consuming it. A queue without a name is
+            exclusive and deleted right now.
+        """
+        if isinstance(target, Subscription):
+            subscriptions = [target] if target in self._subscribers else []
+        else:
+            subscriptions = [subscription for subscription in self._subscribers if subscription.event is target]
+        for subscription in subscriptions:
+            event = subscription.event
+            key = (event.exchange, event.routing_key)
+            logger.info("NAME:", event.name, "EXCHANGE:", event.exchange, "ROUTING_KEY:", event.routing_key,
+                        caller=self)
+            subscription.active = False
+            self._subscribers.remove(subscription)
+            self._bound.discard(subscription)
+            handlers = self._local_handlers.get(event.exchange, [])
+            if subscription in handlers:
+                handlers.remove(subscription)
+                self._local_routes = {}
+            if key in self._shm_readers and subscription in self._shm_readers[key][2]:
+                reader, _, readers = self._shm_readers[key]
+                readers.remove(subscription)
+                if not readers:
+                    reader.close()
+                    del self._shm_readers[key]
+                    self._shm_fallback.discard(key)
+            if subscription.multi:
+                await self._cancel_consumer(subscription, event)
+            elif key in self._event_handler and subscription in self._event_handler[key][1]:
+                self._event_handler[key][1].remove(subscription)
+                if not self._event_handler[key][1]:
+                    del self._event_handler[key]
+                    self._consumed.discard(key)
+                    await self._cancel_consumer(key, event)
+        return len(subscriptions)
+
+    async def _cancel_consumer(self, consumer_key, event: Event):
+        """Cancel a consumer on the current connection, and delete it's queue if it's exclusive."""
+        consumer = self._consumers.pop(consumer_key, None)
+        if not consumer or not self._connected:
+            return
+        channel, consumer_tag, queue_name = consumer
+        try:
+            async with self._channel_lock(channel):
+                await channel.basic_cancel(consumer_tag)
+                if not event.queue:
+                    await channel.queue_delete(queue_name)
+            logger.info("cancel consumer:", consumer_tag, "queue:", queue_name, caller=self)
+        except Exception as e:
+            logger.error("cancel consumer error:", e, caller=self)
+
+    def ready(self):
+        """All modules are initialized and have made their subscriptions, bind them to RabbitMQ right now (or right
+        after connected), don't wait any more."""
+        if self._ready:
+            return
+        self._ready = True
+        self._startup["ready"] = time.time() - self._created
+        if self._connected:
+            self._bind_and_consume()
 
     async def publish(self, event):
         """Publish a event.
 
         Args:
             event: A event to publish.
+
+        Returns:
+            future: Publisher confirm future if `confirm` is enabled for this exchange, otherwise None.
+        """
+        return self.publish_nowait(event)
+
+    def publish_nowait(self, event):
+        """Put a event into the publish queue of it's exchange, the publish writer will send it later.
+
+        Args:
+            event: A event to publish.
+
+        Returns:
+            future: If `confirm` is enabled in exchange options, a future is returned and it's result will be set to
+                True when RabbitMQ confirms this event, or False if this event is dropped or rejected by RabbitMQ.
+                Otherwise None.
+
+        * NOTE:
+            Every exchange has a bounded publish queue, size is `buffer_size` (default is 10000) in exchange options.
+            If the queue is full, the oldest event will be dropped (`drop_policy` is `drop_oldest`, default), or the
+            new event will be dropped (`drop_policy` is `drop_newest`).
+            Every event is stamped with envelope meta here, so the events dropped later show up as gaps on the
+            subscribers.
+            If `batch_window` is set in `Trade` exchange options, `EventTrade` is packed into a `EventTradeBatch`
+            before publishing to RabbitMQ, the future returned is the batch's.
+            If `depth_tiers` is set in `Orderbook` exchange options, every tier of a full orderbook is published
+            before it, the future returned is the full orderbook's.
+            If `delta_keyframe_interval` is set in `Orderbook` exchange options, `EventOrderbook` is published to
+            RabbitMQ as `EventOrderbookDelta`, the subscribers in process and by ring buffer receive the full one.
+        """
+        options = self._exchanges.get(event.exchange, {})
+        if options.get("depth_tiers") and isinstance(event, EventOrderbook) and not event.tier:
+            orderbook = Orderbook.from_smart(event.data)
+            for tier in options["depth_tiers"]:
+                self.publish_nowait(EventOrderbook(orderbook, tier))
+        key = (event.exchange, event.routing_key)
+        seq = self._sequences.get(key, 0) + 1
+        self._sequences[key] = seq
+        event.meta = (self._origin, seq, tools.get_cur_timestamp_us())
+        if self._in_process:
+            self._publish_local(event)
+        if not self._amqp:
+            return None
+        if self._shm_enabled(event.exchange):
+            self._publish_shm(event)
+        if options.get("delta_keyframe_interval") and isinstance(event, EventOrderbook):
+            event = self._make_delta(event, options["delta_keyframe_interval"])
+        if options.get("batch_window") and isinstance(event, EventTrade):
+            return self._add_to_batch(event, options)
+        return self._enqueue(event, options)
+
+    def _make_delta(self, event: EventOrderbook, interval):
+        """Make a orderbook delta event by comparing a orderbook with the previous one of the same routing key, a
+        keyframe is made every `interval` orderbooks, or if the delta is not smaller than the orderbook."""
+        asks, bids = event.data["a"], event.data["b"]
+        new_asks = {price: quantity for price, quantity in asks}
+        new_bids = {price: quantity for price, quantity in bids}
+        state = self._delta_states.get(event.routing_key)
+        seq = state[0] + 1 if state else 1
+        self._delta_states[event.routing_key] = (seq, new_asks, new_bids)
+        if state and (seq - 1) % interval:
+            changed_asks = self._diff_levels(state[1], new_asks)
+            changed_bids = self._diff_levels(state[2], new_bids)
+            if len(changed_asks) + len(changed_bids) < len(asks) + len(bids):
+                return EventOrderbookDelta(event, seq, False, changed_asks, changed_bids)
+        return EventOrderbookDelta(event, seq, True, asks, bids)
+
+    @staticmethod
+    def _diff_levels(old, new):
+        """Changed levels from `old` to `new`, e.g. `[[price, quantity], [price, None], ...]`, None for removed."""
+        changed = [[price, quantity] for price, quantity in new.items() if old.get(price) != quantity]
+        changed.extend([price, None] for price in old if price not in new)
+        return changed
+
+    def _enqueue(self, event, options):
+        """Put a event into the publish queue of it's exchange."""
+        queue = self._publish_queues.get(event.exchange)
+        if queue is None:
+            queue = self._publish_queues[event.exchange] = deque()
+            self._publish_counters[event.exchange] = {"published": 0, "dropped": 0, "batched": 0}
+        future = asyncio.get_event_loop().create_future() if options.get("confirm") else None
+        if len(queue) >= options.get("buffer_size", 10000):
+            self._publish_counters[event.exchange]["dropped"] += 1
+            if options.get("drop_policy", "drop_oldest") == "drop_newest":
+                if future:
+                    future.set_result(False)
+                return future
+            _, dropped = queue.popleft()
+            if dropped:
+                dropped.set_result(False)
+        queue.append((event, future))
+        self._publish_waiter.set()
+        return future
+
+    def _add_to_batch(self, event: EventTrade, options):
+        """Add a trade event into the batch of it's routing key, the batch is published `batch_window` milliseconds
+        after it's first trade added, or right now if it has `batch_size` (default is 1000) trades."""
+        key = (event.exchange, event.routing_key)
+        batch = self._trade_batches.get(key)
+        if batch is None:
+            future = asyncio.get_event_loop().create_future() if options.get("confirm") else None
+            handle = asyncio.get_event_loop().call_later(options["batch_window"] / 1000, self._flush_batch, key)
+            batch = self._trade_batches[key] = ([], future, handle)
+        batch[0].append(event)
+        if len(batch[0]) >= options.get("batch_size", 1000):
+            self._flush_batch(key)
+        return batch[1]
+
+    def _flush_batch(self, key):
+        """Publish the trade batch of a routing key.
+
+        * NOTE:
+            A batch is stamped with it's own sequence number (per routing key, separate from the trades delivered in
+            process or by ring buffer) and the publish time of it's first trade, so the subscribers track batches as
+            messages, and the latency includes the batching delay.
         """
-        if not self._connected:
-            logger.warn("RabbitMQ not ready right now!", caller=self)
+        events, future, handle = self._trade_batches.pop(key)
+        handle.cancel()
+        batch = EventTradeBatch([Trade.from_smart(event.data) for event in events])
+        batch_key = (key[0], key[1], EventTradeBatch.NAME)
+        seq = self._sequences.get(batch_key, 0) + 1
+        self._sequences[batch_key] = seq
+        batch.meta = (self._origin, seq, events[0].meta[2])
+        inner = self._enqueue(batch, self._exchanges.get(key[0], {}))
+        self._publish_counters[key[0]]["batched"] += len(events)
+        if future:
+            inner.add_done_callback(lambda f: future.done() or future.set_result(f.result()))
+
+    def _publish_local(self, event):
+        """Deliver a event to the subscribers in this process, the market object is parsed only once and shared by
+        all subscribers."""
+        key = (event.exchange, event.routing_key)
+        subscriptions = self._local_routes.get(key)
+        if subscriptions is None:
+            subscriptions = [subscription for subscription in self._local_handlers.get(event.exchange, [])
+                             if tools.topic_match(subscription.event.routing_key, event.routing_key) and
+                             subscription.event.match(event.routing_key)]
+            self._local_routes[key] = subscriptions
+        if not subscriptions:
             return
-        data = event.dumps()
-        await self._channel.basic_publish(payload=data, exchange_name=event.exchange, routing_key=event.routing_key)
+        objects = event.parse_all()
+        for subscription in subscriptions:
+            subscription.track(event.meta, event.routing_key)
+            subscription.dispatch(objects, event.routing_key)
+
+    def _shm_enabled(self, exchange):
+        """If shared memory ring buffer transport is enabled for a exchange."""
+        return self._exchanges.get(exchange, {}).get("shm", False)
+
+    def _shm_file(self, key):
+        """Ring buffer file path of a `(exchange, routing_key)`, e.g. `/dev/shm/aioquant/Orderbook.binance.ETH_BTC`."""
+        name = "{}.{}".format(*key).replace("/", "_")
+        return os.path.join(self._shm_path, name)
+
+    def _publish_shm(self, event):
+        """Write a event into the ring buffer of it's routing key, for the subscribers in other processes on this
+        host. The event is published to RabbitMQ as well for the remote subscribers."""
+        key = (event.exchange, event.routing_key)
+        writer = self._shm_writers.get(key)
+        if not writer:
+            options = self._exchanges[event.exchange]
+            writer = RingBufferWriter(self._shm_file(key), options.get("shm_slot_size", 65536),
+                                      options.get("shm_slot_count", 1024))
+            if not self._shm_writers:
+                LoopRunTask.register(self._touch_shm_writers, 1)
+            self._shm_writers[key] = writer
+        writer.write(event.dumps(self._codec, self._compression.get(event.exchange)))
+
+    async def _touch_shm_writers(self, *args, **kwargs):
+        """Update the heartbeats of the ring buffers, so that the readers know this writer is alive even if no event
+        is published."""
+        for writer in self._shm_writers.values():
+            writer.touch()
+
+    def _add_shm_reader(self, subscription: Subscription):
+        """Subscribe a event from the ring buffer instead of RabbitMQ."""
+        event = subscription.event
+        key = (event.exchange, event.routing_key)
+        if key not in self._shm_readers:
+            if not self._shm_polling:
+                self._shm_polling = True
+                SingleTask.run(self._shm_poll)
+            self._shm_readers[key] = (RingBufferReader(self._shm_file(key)), event, [])
+        self._shm_readers[key][2].append(subscription)
+
+    async def _shm_poll(self):
+        """Poll all ring buffer readers, every payload is decoded once and delivered to all subscriptions. The
+        writers are checked every second."""
+        checked_at = 0
+        while True:
+            if time.time() - checked_at >= 1:
+                checked_at = time.time()
+                await self._check_shm_writers()
+            for key, (reader, event, subscriptions) in list(self._shm_readers.items()):
+                payloads = reader.read()
+                if key in self._shm_fallback:
+                    continue  # Consumed from RabbitMQ, the ring buffer is only drained.
+                if key in self._shm_writers and self._in_process:
+                    continue  # Published by this process and delivered in process already.
+                max_age = self._exchanges.get(key[0], {}).get("max_age")
+                for payload in payloads:
+                    try:
+                        if max_age and self._expired(codec.peek_meta(payload), key[1], subscriptions, max_age):
+                            continue
+                        event.loads(payload)
+                        if max_age and self._expired(event.meta, key[1], subscriptions, max_age):
+                            continue
+                        objects = event.parse_all()
+                    except Exception as e:
+                        logger.error("shm event decode error:", e, caller=self)
+                        continue
+                    for subscription in subscriptions:
+                        subscription.track(event.meta, key[1])
+                        subscription.dispatch(objects, key[1])
+            await asyncio.sleep(self._shm_poll_interval)
+
+    async def _check_shm_writers(self):
+        """Consume a routing key from RabbitMQ if the writer of it's ring buffer is gone (or not started), and from
+        the ring buffer again after the writer is back."""
+        for key, (reader, event, subscriptions) in list(self._shm_readers.items()):
+            alive = reader.writer_alive(self._shm_timeout)
+            if not alive and key not in self._shm_fallback:
+                logger.warn("no shm writer alive:", "{}:{}".format(*key), "consume from RabbitMQ", caller=self)
+                self._shm_fallback.add(key)
+                if self._ready and self._connected:
+                    for subscription in subscriptions:
+                        SingleTask.run(self._initialize, subscription)
+            elif alive and key in self._shm_fallback:
+                logger.info("shm writer alive:", "{}:{}".format(*key), "consume from ring buffer", caller=self)
+                self._shm_fallback.discard(key)
+                self._consumed.discard(key)
+                self._bound.difference_update(subscriptions)
+                await self._cancel_consumer(key, event)
+
+    async def _publish_writer(self):
+        """Drain all publish queues, at most `publish_batch_size` events per queue per round, so that a busy
+        exchange can not starve the others.
+
+        * NOTE:
+            The exchanges with `confirm` enabled are skipped if the confirm channel is not open or `confirm_window`
+            is full, the writer is woken up again by the publisher confirms.
+        """
+        while True:
+            await self._publish_waiter.wait()
+            self._publish_waiter.clear()
+            while self._connected:
+                batches = []
+                confirm_open = self._confirm_channel and self._confirm_channel.is_open
+                room = self._confirm_window - len(self._unconfirmed) if confirm_open else 0
+                for name, queue in self._publish_queues.items():
+                    if not queue:
+                        continue
+                    n = min(len(queue), self._publish_batch_size)
+                    if self._exchanges.get(name, {}).get("confirm"):
+                        n = min(n, room)
+                        room -= n
+                    if n > 0:
+                        batches.append((name, [queue.popleft() for _ in range(n)]))
+                if not batches:
+                    break
+                for name, items in batches:
+                    if self._exchanges.get(name, {}).get("confirm"):
+                        await self._publish_confirm(name, items)
+                        continue
+                    channel = self._get_publish_channel(name)
+                    counter = self._publish_counters[name]
+                    published = 0
+                    try:
+                        for event, _ in items:
+                            data = event.dumps(self._codec, self._compression.get(name))
+                            await channel.basic_publish(payload=data, exchange_name=name,
+                                                        routing_key=event.routing_key, properties=self._properties)
+                            published += 1
+                    except Exception as e:
+                        counter["dropped"] += len(items) - published
+                        logger.error("publish error:", e, caller=self)
+                    counter["published"] += published
+
+    async def _publish_confirm(self, name, items):
+        """Publish events by the confirm channel, the writer takes at most the free room of `confirm_window` events,
+        so that this never waits for confirmation.
+
+        * NOTE:
+            Unconfirmed events are kept in `self._unconfirmed` and will be published again after reconnected (or the
+            confirm channel reopened). If connection lost or the confirm channel closed, the events not published yet
+            are put back to the head of the publish queue.
+        """
+        counter = self._publish_counters[name]
+        channel = self._confirm_channel
+        for index, (event, future) in enumerate(items):
+            if not self._connected or not channel or not channel.is_open or channel is not self._confirm_channel:
+                self._publish_queues[name].extendleft(reversed(items[index:]))
+                return
+            self._confirm_tag += 1
+            self._unconfirmed[self._confirm_tag] = (name, event, future)
+            try:
+                data = event.dumps(self._codec, self._compression.get(name))
+                await channel.basic_publish(payload=data, exchange_name=name, routing_key=event.routing_key,
+                                            properties=self._properties)
+                counter["published"] += 1
+            except Exception as e:
+                logger.error("publish error:", e, caller=self)
+                self._publish_queues[name].extendleft(reversed(items[index + 1:]))
+                return
+
+    async def _on_confirm(self, confirmed, frame):
+        """Publisher confirm (`basic.ack` / `basic.nack`) callback of the confirm channel.
+
+        Args:
+            confirmed: True for `basic.ack`, False for `basic.nack`.
+            frame: Confirm frame, `delivery_tag` and `multiple` are used.
+        """
+        if frame.multiple:
+            while self._unconfirmed:
+                tag = next(iter(self._unconfirmed))
+                if tag > frame.delivery_tag:
+                    break
+                _, _, future = self._unconfirmed.pop(tag)
+                if future and not future.done():
+                    future.set_result(confirmed)
+        else:
+            _, _, future = self._unconfirmed.pop(frame.delivery_tag, (None, None, None))
+            if future and not future.done():
+                future.set_result(confirmed)
+        self._publish_waiter.set()
+
+    def _replay_unconfirmed(self):
+        """Put all unconfirmed events back to the head of their publish queues, so that they will be published again
+        in order."""
+        for name, event, future in reversed(list(self._unconfirmed.values())):
+            self._publish_queues[name].appendleft((event, future))
+        self._unconfirmed = OrderedDict()
+        self._confirm_tag = 0
+
+    def _get_publish_channel(self, exchange):
+        """Get the publish channel of a exchange, events of the same exchange are always published by the same
+        channel, so they are kept in order."""
+        index = list(self._publish_queues).index(exchange)
+        return self._publish_channels[index % len(self._publish_channels)]
 
     async def connect(self, reconnect=False):
         """Connect to RabbitMQ server and create default exchange.
@@ -249,85 +1275,477 @@ class EventCenter:
         if self._connected:
             return
 
-        # Create a connection.
+        # Create connections, publish and consume share the same connection if `separate_connections` is false.
+        confirm = any(options.get("confirm") for options in self._exchanges.values())
         try:
-            transport, protocol = await aioamqp.connect(host=self._host, port=self._port, login=self._username,
-                                                        password=self._password, login_method="PLAIN")
+            protocol = await self._create_connection()
+            self._protocols = [protocol]
+            if self._separate_connections:
+                self._protocols.append(await self._create_connection())
+            self._publish_channels = [await protocol.channel() for _ in range(self._publish_channel_count)]
+            self._consume_channels = {}
+            if confirm:
+                self._confirm_channel = await self._open_confirm_channel(protocol)
+
+            # Create default exchanges.
+            exchanges = ["Orderbook", "Kline", "Trade"]
+            for name in exchanges:
+                await self._publish_channels[0].exchange_declare(exchange_name=name, type_name="topic")
+            logger.debug("create default exchanges success!", caller=self)
         except Exception as e:
             logger.error("connection error:", e, caller=self)
+            await self._close_connections()
             return
-        finally:
-            if self._connected:
-                return
-        channel = await protocol.channel()
-        self._protocol = protocol
-        self._channel = channel
+        if self._connected:
+            return
+        for channel in self._publish_channels + ([self._confirm_channel] if confirm else []):
+            self._watch_channel(channel)
+        if confirm:
+            self._replay_unconfirmed()
         self._connected = True
         logger.info("Rabbitmq initialize success!", caller=self)
 
-        # Create default exchanges.
-        exchanges = ["Orderbook", "Kline", "Trade"]
-        for name in exchanges:
-            await self._channel.exchange_declare(exchange_name=name, type_name="topic")
-        logger.debug("create default exchanges success!", caller=self)
+        if not reconnect:
+            self._startup["connected"] = time.time() - self._created
+        elif self._ready:
+            # Bind before publishing the buffered events, so that the subscribers in this process can receive them.
+            await self._bind_all()
+
+        # Wake up the publish writer to send events buffered while disconnected.
+        self._publish_waiter.set()
 
-        if reconnect:
+        if not reconnect and self._ready:
             self._bind_and_consume()
-        else:
-            # Maybe we should waiting for all modules to be initialized successfully.
-            asyncio.get_event_loop().call_later(5, self._bind_and_consume)
+        elif not reconnect:
+            # Nobody tells the event center is ready (e.g. not started by `quant.start`), bind 5 seconds later.
+            asyncio.get_event_loop().call_later(5, self.ready)
+
+    async def _open_confirm_channel(self, protocol):
+        """Open a channel in confirm mode."""
+        channel = await protocol.channel()
+        await channel.confirm_select()
+        # aioamqp resolves only it's own waiters and ignores `multiple`, so confirms are tracked here.
+        channel.basic_server_ack = functools.partial(self._on_confirm, True)
+        channel.basic_server_nack = functools.partial(self._on_confirm, False)
+        return channel
+
+    async def _create_connection(self):
+        """Create a AMQP connection, or a connection of the in-memory broker if `RABBITMQ.transport` is `memory`."""
+        if self._transport == "memory":
+            transport, protocol = await broker.connect()
+            return protocol
+        kwargs = {"heartbeat": self._heartbeat} if self._heartbeat else {}
+        transport, protocol = await aioamqp.connect(host=self._host, port=self._port, login=self._username,
+                                                    password=self._password, login_method="PLAIN", **kwargs)
+        return protocol
+
+    def _watch_channel(self, channel, exchange=None):
+        """Watch a channel. If it's closed because the connection is gone, reconnect right now. If only the channel
+        is closed by the server because of a channel error (e.g. 406 for a queue declared with different arguments),
+        reopen the channel, the connections and the other channels are kept.
+
+        Args:
+            channel: Channel to watch.
+            exchange: Exchange name of a consume channel, None for the publish channels and the confirm channel.
+        """
+        generation = self._generation
+
+        async def watch():
+            await channel.close_event.wait()
+            if generation != self._generation:
+                return
+            if channel.protocol.state != OPEN:
+                await self._on_connection_lost("channel {} closed".format(channel.channel_id))
+            else:
+                await self._on_channel_closed(channel, exchange)
+        SingleTask.run(watch)
+
+    async def _on_channel_closed(self, channel, exchange=None):
+        """Reopen a channel closed by a channel error, after a exponential backoff delay if it's closed again soon,
+        so that a error repeated by every rebinding does not flood the server.
+
+        * NOTE:
+            The subscriptions of a closed consume channel are bound again on a new channel. The unconfirmed events of
+            a closed confirm channel are published again, and events published by a closed publish channel before
+            it's reopened are dropped, the same as publish errors.
+        """
+        if channel in self._reopening:
+            return
+        if exchange:
+            if self._consume_channels.get(exchange) is not channel:
+                return
+        elif channel is not self._confirm_channel and channel not in self._publish_channels:
+            return
+        self._reopening.add(channel)
+        generation = self._generation
+        key = exchange or "publish"
+        attempt, last_failure = self._channel_failures.get(key, (0, 0))
+        if time.time() - last_failure > self._reconnect_max_delay * 2:
+            attempt = 0  # The channel has been working for a while.
+        self._channel_failures[key] = (attempt + 1, time.time())
+        delay = min(self._reconnect_max_delay, self._reconnect_delay * 2 ** attempt) * random.uniform(0.5, 1)
+        logger.error("channel", channel.channel_id, "closed, exchange:", exchange, "reopen after", delay, "seconds",
+                     caller=self)
+        if exchange:
+            # Forget the queues and consumers of the closed channel, so that the subscriptions are bound again.
+            del self._consume_channels[exchange]
+            self._channel_locks.pop(channel, None)
+            state = self._acks.pop(channel, None)
+            if state and state["timer"]:
+                state["timer"].cancel()
+            for consumer_key, consumer in list(self._consumers.items()):
+                if consumer[0] is channel:
+                    del self._consumers[consumer_key]
+            self._bound = {subscription for subscription in self._bound if subscription.event.exchange != exchange}
+            self._consumed = {k for k in self._consumed if k[0] != exchange}
+        await asyncio.sleep(delay)
+        if generation != self._generation or not self._connected:
+            return  # Reconnected, everything is created again.
+        try:
+            if exchange:
+                self._reopening.discard(channel)
+                if self._ready:
+                    await self._bind_all()
+                return
+            if channel is self._confirm_channel:
+                new_channel = self._confirm_channel = await self._open_confirm_channel(self._protocols[0])
+                self._replay_unconfirmed()
+            else:
+                new_channel = await self._protocols[0].channel()
+                self._publish_channels[self._publish_channels.index(channel)] = new_channel
+            self._watch_channel(new_channel)
+            self._reopening.discard(channel)
+            self._publish_waiter.set()
+            logger.info("channel reopened:", new_channel.channel_id, caller=self)
+        except Exception as e:
+            logger.error("reopen channel error:", e, caller=self)
+            self._reopening.discard(channel)
+            await self._check_connection()
+
+    async def _close_connections(self):
+        """Close all AMQP connections."""
+        self._generation += 1
+        for protocol in self._protocols:
+            try:
+                await protocol.close()
+            except Exception:
+                pass
+        self._protocols = []
+        self._publish_channels = []
+        self._consume_channels = {}
+        self._channel_locks = {}
+        self._confirm_channel = None
+        self._reopening = set()
+
+    @async_method_locker("EventCenter._get_consume_channel")
+    async def _get_consume_channel(self, exchange):
+        """Get the consume channel of a exchange, every exchange has it's own consume channel, so a busy exchange
+        can not delay deliveries and acknowledgements of the others."""
+        channel = self._consume_channels.get(exchange)
+        if not channel:
+            channel = await self._protocols[-1].channel()
+            self._consume_channels[exchange] = channel
+            self._watch_channel(channel, exchange)
+        return channel
+
+    def _channel_lock(self, channel):
+        """Get the lock of a consume channel. aioamqp waits for one response per RPC method on a channel, a second
+        `queue_declare` sent before the first one answered fails with `SynchronizationError`, so the RPCs of a channel
+        are sent one by one, the subscriptions of different exchanges are still bound concurrently."""
+        lock = self._channel_locks.get(channel)
+        if not lock:
+            lock = self._channel_locks[channel] = asyncio.Lock()
+        return lock
 
     def _bind_and_consume(self):
-        async def do_them():
-            for event, callback, multi in self._subscribers:
-                await self._initialize(event, callback, multi)
-        SingleTask.run(do_them)
+        SingleTask.run(self._bind_all)
+
+    async def _bind_all(self):
+        """Bind all subscriptions, the exchanges are bound concurrently."""
+        results = await asyncio.gather(*[self._initialize(subscription) for subscription in self._subscribers],
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error("bind error:", result, caller=self)
+        if "bound" not in self._startup:
+            self._startup["bound"] = time.time() - self._created
+            logger.info("subscriptions bound:", len(results), "startup:", self._startup, caller=self)
+
+    async def _initialize(self, subscription: Subscription):
+        """Declare, bind and consume the queue of a subscription, a subscription is bound only once per connection.
+
+        * NOTE:
+            Subscriptions with the same routing key share one queue and one consumer. The routing key is marked as
+            consumed before any I/O, so the subscriptions bound concurrently can see it and share the consumer. If
+            binding failed, the marks are removed, so the subscriptions sharing the routing key are bound again by the
+            next `_bind_all`.
+        """
+        event = subscription.event
+        key = (event.exchange, event.routing_key)
+        if subscription in self._bound or subscription not in self._subscribers:
+            return
+        if key in self._shm_readers and key not in self._shm_fallback:
+            if self._shm_readers[key][0].writer_alive(self._shm_timeout):
+                return
+            logger.warn("no shm writer alive:", "{}:{}".format(*key), "consume from RabbitMQ", caller=self)
+            self._shm_fallback.add(key)
+        self._bound.add(subscription)
+        shared = subscription.callback and not subscription.multi
+        if shared:
+            if key in self._consumed:
+                return
+            self._consumed.add(key)
+        try:
+            channel = await self._get_consume_channel(event.exchange)
+            async with self._channel_lock(channel):
+                consumer = await self._declare_and_consume(channel, subscription)
+        except Exception:
+            if shared:
+                self._consumed.discard(key)
+                self._bound.difference_update(self._event_handler.get(key, (None, []))[1])
+            self._bound.discard(subscription)
+            raise
+        if not consumer:
+            return
+        if subscription.multi:
+            consumer_key, unsubscribed = subscription, subscription not in self._subscribers
+        else:
+            consumer_key = key
+            unsubscribed = key not in self._event_handler or key in self._shm_readers and key not in self._shm_fallback
+        self._consumers[consumer_key] = consumer
+        if unsubscribed:  # Unsubscribed (or switched to the ring buffer) while binding.
+            await self._cancel_consumer(consumer_key, event)
 
-    async def _initialize(self, event: Event, callback=None, multi=False):
+    async def _declare_and_consume(self, channel, subscription: Subscription):
+        """Declare and bind the queue of a subscription, and start consuming if it has a callback.
+
+        Returns:
+            consumer: `(channel, consumer_tag, queue_name)`, None if the subscription has no callback.
+        """
+        event = subscription.event
+        options = self._exchanges.get(event.exchange, {})
+        arguments = options.get("queue_arguments")  # e.g. `{"x-max-length": 100, "x-message-ttl": 5000}`
         if event.queue:
-            await self._channel.queue_declare(queue_name=event.queue, auto_delete=True)
+            await channel.queue_declare(queue_name=event.queue, auto_delete=True, arguments=arguments)
             queue_name = event.queue
         else:
-            result = await self._channel.queue_declare(exclusive=True)
+            result = await channel.queue_declare(exclusive=True, arguments=arguments)
             queue_name = result["queue"]
-        await self._channel.queue_bind(queue_name=queue_name, exchange_name=event.exchange,
-                                       routing_key=event.routing_key)
-        await self._channel.basic_qos(prefetch_count=event.prefetch_count)
-        if callback:
-            if multi:
-                await self._channel.basic_consume(callback=callback, queue_name=queue_name, no_ack=True)
-                logger.info("multi message queue:", queue_name, caller=self)
+        for routing_key in event.bindings:
+            await channel.queue_bind(queue_name=queue_name, exchange_name=event.exchange, routing_key=routing_key)
+        no_ack = not self._multi_acked(options) if subscription.multi else options.get("no_ack", False)
+        if not no_ack:
+            await channel.basic_qos(prefetch_count=options.get("prefetch_count", event.prefetch_count))
+        if not subscription.callback:
+            return None
+        if subscription.multi:
+            on_message = functools.partial(self._on_consume_multi_msg, subscription)
+        else:
+            on_message = functools.partial(self._on_consume_event_msg, (event.exchange, event.routing_key))
+        result = await channel.basic_consume(on_message, queue_name=queue_name, no_ack=no_ack)
+        logger.info("multi message queue:" if subscription.multi else "queue:", queue_name, caller=self)
+        return channel, result["consumer_tag"], queue_name
+
+    async def _on_consume_multi_msg(self, subscription: Subscription, channel, body, envelope, properties):
+        """Consume a message from a queue bound with wildcard routing key, the events published by this process are
+        skipped if they have been delivered in process already.
+
+        * NOTE:
+            By default the messages are not acknowledged and the callback is not awaited, as the legacy wildcard
+            subscribers. If the exchange options opt in (see `_multi_acked`), the message is acknowledged after the
+            callback returned, so the prefetch window bounds the messages pushed to a slow subscriber, and the others
+            are kept in the broker queue where `queue_arguments` (e.g. `x-max-length`) can drop the stale ones.
+        """
+        event = subscription.event
+        options = self._exchanges.get(event.exchange, {})
+        acked = self._multi_acked(options)
+        try:
+            if self._in_process and properties.app_id == self._app_id:
+                return
+            if not event.match(envelope.routing_key):  # e.g. a orderbook depth tier.
+                return
+            max_age = options.get("max_age")
+            if max_age and self._expired(codec.peek_meta(body), envelope.routing_key, [subscription], max_age):
+                return
+            event.loads(body)
+            if max_age and self._expired(event.meta, envelope.routing_key, [subscription], max_age):
+                return
+            objects = event.parse_all()
+            subscription.track(event.meta, envelope.routing_key)
+            if not objects:
+                return
+            if subscription.conflate or not acked:
+                subscription.dispatch(objects, envelope.routing_key)
             else:
-                await self._channel.basic_consume(self._on_consume_event_msg, queue_name=queue_name)
-                logger.info("queue:", queue_name, caller=self)
-                self._add_event_handler(event, callback)
+                await subscription.run(objects)
+        except:
+            logger.error("event handle error! body:", body, caller=self)
+            return
+        finally:
+            if acked:
+                await self._ack(channel, envelope.delivery_tag, options)
+
+    @staticmethod
+    def _multi_acked(options):
+        """If the wildcard subscribers of a exchange acknowledge messages, only if `no_ack` is `false` or any of
+        `queue_arguments` / `max_age` / `prefetch_count` / `ack_batch` is set (and `no_ack` is not `true`) in the
+        exchange options."""
+        if "no_ack" in options:
+            return not options["no_ack"]
+        return any(options.get(key) for key in ("queue_arguments", "max_age", "prefetch_count", "ack_batch"))
+
+    async def _on_consume_event_msg(self, key, channel, body, envelope, properties):
+        """Decode a message only once and deliver the same market object to all handlers of this queue.
 
-    async def _on_consume_event_msg(self, channel, body, envelope, properties):
+        Args:
+            key: Handler key bound to the consumer, `(exchange, routing_key)`.
+        """
         try:
-            key = "{exchange}:{routing_key}".format(exchange=envelope.exchange_name, routing_key=envelope.routing_key)
-            funcs = self._event_handler[key]
-            for func in funcs:
-                SingleTask.run(func, channel, body, envelope, properties)
+            if self._in_process and properties.app_id == self._app_id:
+                return
+            event, subscriptions = self._event_handler[key]
+            max_age = self._exchanges.get(key[0], {}).get("max_age")
+            if max_age and self._expired(codec.peek_meta(body), envelope.routing_key, subscriptions, max_age):
+                return
+            event.loads(body)
+            if max_age and self._expired(event.meta, envelope.routing_key, subscriptions, max_age):
+                return
+            objects = event.parse_all()
+            for subscription in subscriptions:
+                subscription.track(event.meta, envelope.routing_key)
+            if not objects:  # e.g. a kline of another type published by a legacy publisher, or waiting for keyframe.
+                return
+            for subscription in subscriptions:
+                subscription.dispatch(objects, envelope.routing_key)
         except:
             logger.error("event handle error! body:", body, caller=self)
             return
         finally:
-            await self._channel.basic_client_ack(delivery_tag=envelope.delivery_tag)  # response ack
+            options = self._exchanges.get(key[0], {})
+            if not options.get("no_ack"):
+                await self._ack(channel, envelope.delivery_tag, options)  # response ack
 
-    def _add_event_handler(self, event: Event, callback):
-        key = "{exchange}:{routing_key}".format(exchange=event.exchange, routing_key=event.routing_key)
+    def _expired(self, meta, routing_key, subscriptions, max_age):
+        """Check if a message is older than `max_age`(millisecond) according to it's publish time, a expired message
+        is still tracked by the subscriptions, so it's not counted as a gap.
+
+        * NOTE:
+            The meta of a message in the header byte formats is read before decoding, so a expired message costs
+            nothing, the legacy format has to be decoded first, but a expired message is not parsed.
+        """
+        if not meta or tools.get_cur_timestamp_us() - meta[2] <= max_age * 1000:
+            return False
+        for subscription in subscriptions:
+            subscription.track(meta, routing_key)
+            subscription.expired += 1
+        return True
+
+    async def _ack(self, channel, delivery_tag, options):
+        """Acknowledge a message. If `ack_batch` in exchange options is greater than 1, the acknowledgements are
+        batched and sent as one cumulative acknowledgement (`multiple=True`) every `ack_batch` messages or every
+        `ack_interval` milliseconds (default is 100ms).
+
+        * NOTE:
+            Messages are acknowledged after being dispatched, and dispatching is in order of delivery, so a cumulative
+            acknowledgement never covers a message that has not been dispatched.
+        """
+        ack_batch = options.get("ack_batch", 1)
+        if ack_batch <= 1:
+            await channel.basic_client_ack(delivery_tag=delivery_tag)
+            return
+        state = self._acks.get(channel)
+        if not state:
+            state = self._acks[channel] = {"tag": 0, "count": 0, "timer": None}
+        state["tag"] = delivery_tag
+        state["count"] += 1
+        if state["count"] >= ack_batch:
+            await self._flush_ack(channel)
+        elif not state["timer"]:
+            delay = options.get("ack_interval", 100) / 1000
+            state["timer"] = asyncio.get_event_loop().call_later(delay, SingleTask.run, self._flush_ack, channel)
+
+    async def _flush_ack(self, channel):
+        """Send the pending cumulative acknowledgement of a channel."""
+        state = self._acks.get(channel)
+        if not state or not state["count"]:
+            return
+        if state["timer"]:
+            state["timer"].cancel()
+            state["timer"] = None
+        state["count"] = 0
+        try:
+            await channel.basic_client_ack(delivery_tag=state["tag"], multiple=True)
+        except Exception as e:
+            logger.error("ack error:", e, caller=self)
+
+    def _add_event_handler(self, subscription: Subscription):
+        event = subscription.event
+        key = (event.exchange, event.routing_key)
         if key in self._event_handler:
-            self._event_handler[key].append(callback)
+            if subscription not in self._event_handler[key][1]:
+                self._event_handler[key][1].append(subscription)
         else:
-            self._event_handler[key] = [callback]
+            self._event_handler[key] = (event, [subscription])
         logger.debug("event handlers:", self._event_handler.keys(), caller=self)
 
     async def _check_connection(self, *args, **kwargs):
-        if self._connected and self._channel and self._channel.is_open:
+        """Check connection every 10 seconds, the fallback of channel watchers: reconnect if a connection is gone,
+        reopen the channels closed, and bind the subscriptions failed to bind."""
+        if self._reconnecting:
+            return
+        if not self._connected or not self._protocols or any(p.state != OPEN for p in self._protocols):
+            await self._on_connection_lost("connection check failed")
             return
-        logger.error("CONNECTION LOSE! START RECONNECT RIGHT NOW!", caller=self)
-        self._connected = False
-        self._protocol = None
-        self._channel = None
-        self._event_handler = {}
-        SingleTask.run(self.connect, reconnect=True)
+        channels = [(channel, None) for channel in self._publish_channels]
+        channels += [(channel, exchange) for exchange, channel in self._consume_channels.items()]
+        if self._confirm_channel:
+            channels.append((self._confirm_channel, None))
+        for channel, exchange in channels:
+            if not channel.is_open:
+                SingleTask.run(self._on_channel_closed, channel, exchange)
+        if self._ready and not self._reopening:
+            await self._bind_all()
+
+    async def _on_connection_lost(self, reason):
+        """Close all connections and reconnect with exponential backoff and jitter, until connected.
+
+        * NOTE:
+            Subscriptions and their handlers are kept, only the queues, bindings and consumers are created again on
+            the new connection. Events published while disconnected are buffered in the publish queues.
+        """
+        if self._reconnecting:
+            self._lost_while_reconnecting = True  # e.g. the new connection is gone, check again after reconnected.
+            return
+        self._reconnecting = True
+        self._lost_while_reconnecting = False
+        try:
+            logger.error("CONNECTION LOSE! START RECONNECT RIGHT NOW!", reason, caller=self)
+            lost_at = time.time()
+            self._connected = False
+            await self._close_connections()
+            self._bound = set()
+            self._consumed = set()
+            self._consumers = {}
+            for state in self._acks.values():
+                if state["timer"]:
+                    state["timer"].cancel()
+            self._acks = {}
+            attempt = 0
+            while True:
+                await self.connect(reconnect=True)
+                if self._connected:
+                    break
+                delay = min(self._reconnect_max_delay, self._reconnect_delay * 2 ** attempt)
+                delay *= random.uniform(0.5, 1)  # Jitter, so that all processes don't reconnect at the same time.
+                attempt += 1
+                logger.warn("reconnect failed, attempt:", attempt, "retry after", delay, "seconds", caller=self)
+                await asyncio.sleep(delay)
+            self._reconnects += 1
+            self._last_downtime = time.time() - lost_at
+            self._downtime += self._last_downtime
+            logger.info("reconnected, downtime:", self._last_downtime, caller=self)
+        finally:
+            self._reconnecting = False
+        if self._lost_while_reconnecting:
+            self._lost_while_reconnecting = False
+            await self._check_connection()
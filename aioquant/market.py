@@ -9,12 +9,41 @@ Email:  huangtao@ifclover.com
 """
 
 import json
+import datetime
+import itertools
+from array import array
+from collections import deque
 
 from aioquant import const
+from aioquant.utils import tools
 from aioquant.utils import logger
+from aioquant.tasks import LoopRunTask, SingleTask
+from aioquant.order import ORDER_ACTION_BUY, ORDER_ACTION_SELL
 
 
-class Orderbook:
+class MarketObject:
+    """Market object base, a `__slots__` based value type. The `data` / `smart` dicts are built at every access and
+    not kept by the object, so holding many objects costs only their attributes.
+    """
+
+    __slots__ = ()
+
+    @property
+    def data(self):
+        raise NotImplementedError
+
+    @property
+    def smart(self):
+        raise NotImplementedError
+
+    def __str__(self):
+        return json.dumps(self.data)
+
+    def __repr__(self):
+        return str(self)
+
+
+class Orderbook(MarketObject):
     """Orderbook object.
 
     Args:
@@ -23,8 +52,15 @@ class Orderbook:
         asks: Asks list, e.g. `[[price, quantity], [...], ...]`
         bids: Bids list, e.g. `[[price, quantity], [...], ...]`
         timestamp: Update time, millisecond.
+
+    * NOTE:
+        The string and the array-backed representation are built at the first access and cached, the cache is dropped
+        if any attribute is assigned since then. Modifying a list attribute in place (e.g. `orderbook.asks.append`)
+        doesn't drop the cache, assign a new list instead.
     """
 
+    __slots__ = ("platform", "symbol", "asks", "bids", "timestamp", "_cache", )
+
     def __init__(self, platform=None, symbol=None, asks=None, bids=None, timestamp=None):
         """Initialize."""
         self.platform = platform
@@ -32,6 +68,28 @@ class Orderbook:
         self.asks = asks
         self.bids = bids
         self.timestamp = timestamp
+        self._cache = None  # e.g. `(attribute values, {"str": "...", "array": ArrayOrderbook})`
+
+    @classmethod
+    def from_smart(cls, d):
+        """Create a orderbook from it's smart dict."""
+        return cls(d["p"], d["s"], d["a"], d["b"], d["t"])
+
+    def _cached(self, key, build):
+        """Get a cached value, build it if not cached or any attribute is assigned since it's cached."""
+        values = (self.platform, self.symbol, self.asks, self.bids, self.timestamp)
+        cache = self._cache
+        if cache is None or cache[0] != values:
+            cache = self._cache = (values, {})
+        value = cache[1].get(key)
+        if value is None:
+            value = cache[1][key] = build()
+        return value
+
+    @property
+    def array(self):
+        """Array-backed representation, built at the first access and cached, shared by all subscribers."""
+        return self._cached("array", lambda: ArrayOrderbook.from_orderbook(self))
 
     @property
     def data(self):
@@ -44,6 +102,9 @@ class Orderbook:
         }
         return d
 
+    def __str__(self):
+        return self._cached("str", lambda: json.dumps(self.data))
+
     @property
     def smart(self):
         d = {
@@ -63,15 +124,157 @@ class Orderbook:
         self.timestamp = d["t"]
         return self
 
+
+class ArrayOrderbook:
+    """Array-backed orderbook, prices and quantities are contiguous float64 columns (`array.array("d")`), converted
+    from strings only once, and the analytics helpers run over the columns without converting again.
+
+    Args:
+        platform: Exchange platform name, e.g. `binance` / `bitmex`.
+        symbol: Trade pair name, e.g. `ETH/BTC`.
+        ask_prices: Ask prices, ascending.
+        ask_quantities: Ask quantities.
+        bid_prices: Bid prices, descending.
+        bid_quantities: Bid quantities.
+        timestamp: Update time, millisecond.
+        asks: Source asks the columns are converted from, e.g. `[[price, quantity], ...]`. Default is None.
+        bids: Source bids, same as `asks`.
+
+    * NOTE:
+        `smart` / `to_orderbook` return the source levels as they are (e.g. `"0.10000000"` is kept), so a orderbook
+        created by `from_levels` / `from_orderbook` / `from_smart` round-trips exactly. If it's created from columns
+        only, the floats are formatted by `repr` (e.g. `0.1` becomes `"0.1"`).
+    """
+
+    __slots__ = ("platform", "symbol", "ask_prices", "ask_quantities", "bid_prices", "bid_quantities", "timestamp",
+                 "asks", "bids", )
+
+    def __init__(self, platform=None, symbol=None, ask_prices=None, ask_quantities=None, bid_prices=None,
+                 bid_quantities=None, timestamp=None, asks=None, bids=None):
+        """Initialize."""
+        self.platform = platform
+        self.symbol = symbol
+        self.ask_prices = ask_prices if ask_prices is not None else array("d")
+        self.ask_quantities = ask_quantities if ask_quantities is not None else array("d")
+        self.bid_prices = bid_prices if bid_prices is not None else array("d")
+        self.bid_quantities = bid_quantities if bid_quantities is not None else array("d")
+        self.timestamp = timestamp
+        self.asks = asks
+        self.bids = bids
+
+    @classmethod
+    def from_levels(cls, platform, symbol, asks, bids, timestamp):
+        """Create from levels, e.g. `[[price, quantity], ...]`, price and quantity can be string or number."""
+        return cls(platform, symbol,
+                   array("d", [float(level[0]) for level in asks]), array("d", [float(level[1]) for level in asks]),
+                   array("d", [float(level[0]) for level in bids]), array("d", [float(level[1]) for level in bids]),
+                   timestamp, asks, bids)
+
+    @classmethod
+    def from_orderbook(cls, orderbook: Orderbook):
+        return cls.from_levels(orderbook.platform, orderbook.symbol, orderbook.asks or [], orderbook.bids or [],
+                               orderbook.timestamp)
+
+    @classmethod
+    def from_smart(cls, d):
+        return cls.from_levels(d["p"], d["s"], d["a"], d["b"], d["t"])
+
+    @property
+    def smart(self):
+        asks, bids = self.asks, self.bids
+        if asks is None:
+            asks = [[repr(p), repr(q)] for p, q in zip(self.ask_prices, self.ask_quantities)]
+        if bids is None:
+            bids = [[repr(p), repr(q)] for p, q in zip(self.bid_prices, self.bid_quantities)]
+        d = {
+            "p": self.platform,
+            "s": self.symbol,
+            "a": asks,
+            "b": bids,
+            "t": self.timestamp
+        }
+        return d
+
+    def to_orderbook(self):
+        return Orderbook.from_smart(self.smart)
+
+    @property
+    def best_ask(self):
+        return self.ask_prices[0] if self.ask_prices else None
+
+    @property
+    def best_bid(self):
+        return self.bid_prices[0] if self.bid_prices else None
+
+    @property
+    def mid(self):
+        if not self.ask_prices or not self.bid_prices:
+            return None
+        return (self.ask_prices[0] + self.bid_prices[0]) / 2
+
+    @property
+    def spread(self):
+        if not self.ask_prices or not self.bid_prices:
+            return None
+        return self.ask_prices[0] - self.bid_prices[0]
+
+    def _side(self, side):
+        if side == ORDER_ACTION_BUY:  # Buy from asks.
+            return self.ask_prices, self.ask_quantities
+        return self.bid_prices, self.bid_quantities
+
+    def depth(self, side, levels=None):
+        """Cumulative quantities of the first `levels` levels.
+
+        Args:
+            side: `BUY` for asks (to buy from), `SELL` for bids (to sell to).
+            levels: How many levels, default is all levels.
+
+        Returns:
+            depth: Cumulative quantities array, e.g. `array("d", [1.0, 3.0, 3.5])`.
+        """
+        _, quantities = self._side(side)
+        return array("d", itertools.accumulate(quantities[:levels]))
+
+    def vwap(self, side, size):
+        """Volume weighted average price to fill `size` by taking the levels in order.
+
+        Args:
+            side: `BUY` takes asks, `SELL` takes bids.
+            size: Quantity to fill.
+
+        Returns:
+            price: Average fill price, None if the orderbook is not deep enough or `size` is not positive.
+        """
+        if size <= 0:
+            return None
+        prices, quantities = self._side(side)
+        remain = size
+        cost = 0
+        for price, quantity in zip(prices, quantities):
+            if quantity >= remain:
+                return (cost + price * remain) / size
+            cost += price * quantity
+            remain -= quantity
+        return None
+
+    def imbalance(self, levels=None):
+        """Bid / ask quantity imbalance of the first `levels` levels, `(bids - asks) / (bids + asks)`, in `[-1, 1]`,
+        None if both sides are empty."""
+        bids = sum(self.bid_quantities[:levels])
+        asks = sum(self.ask_quantities[:levels])
+        if not bids + asks:
+            return None
+        return (bids - asks) / (bids + asks)
+
     def __str__(self):
-        info = json.dumps(self.data)
-        return info
+        return json.dumps(self.smart)
 
     def __repr__(self):
         return str(self)
 
 
-class Trade:
+class Trade(MarketObject):
     """Trade object.
 
     Args:
@@ -83,6 +286,8 @@ class Trade:
         timestamp: Update time, millisecond.
     """
 
+    __slots__ = ("platform", "symbol", "action", "price", "quantity", "timestamp", )
+
     def __init__(self, platform=None, symbol=None, action=None, price=None, quantity=None, timestamp=None):
         """Initialize."""
         self.platform = platform
@@ -92,6 +297,11 @@ class Trade:
         self.quantity = quantity
         self.timestamp = timestamp
 
+    @classmethod
+    def from_smart(cls, d):
+        """Create a trade from it's smart dict."""
+        return cls(d["p"], d["s"], d["a"], d["P"], d["q"], d["t"])
+
     @property
     def data(self):
         d = {
@@ -125,15 +335,8 @@ class Trade:
         self.timestamp = d["t"]
         return self
 
-    def __str__(self):
-        info = json.dumps(self.data)
-        return info
 
-    def __repr__(self):
-        return str(self)
-
-
-class Kline:
+class Kline(MarketObject):
     """Kline object.
 
     Args:
@@ -148,6 +351,8 @@ class Kline:
         kline_type: Kline type name, `kline`, `kline_5min`, `kline_15min` ... and so on.
     """
 
+    __slots__ = ("platform", "symbol", "open", "high", "low", "close", "volume", "timestamp", "kline_type", )
+
     def __init__(self, platform=None, symbol=None, open=None, high=None, low=None, close=None, volume=None,
                  timestamp=None, kline_type=None):
         """Initialize."""
@@ -161,6 +366,11 @@ class Kline:
         self.timestamp = timestamp
         self.kline_type = kline_type
 
+    @classmethod
+    def from_smart(cls, d):
+        """Create a kline from it's smart dict."""
+        return cls(d["p"], d["s"], d["o"], d["h"], d["l"], d["c"], d["v"], d["t"], d["kt"])
+
     @property
     def data(self):
         d = {
@@ -203,8 +413,381 @@ class Kline:
         self.kline_type = d["kt"]
         return self
 
+
+MINUTE = 60 * 1000
+DAY = 24 * 60 * MINUTE
+
+# Kline types built by `KlineAggregator` and their intervals(millisecond), None for the calendar month / year.
+KLINE_INTERVALS = {
+    const.MARKET_TYPE_KLINE: MINUTE,
+    const.MARKET_TYPE_KLINE_3M: 3 * MINUTE,
+    const.MARKET_TYPE_KLINE_5M: 5 * MINUTE,
+    const.MARKET_TYPE_KLINE_15M: 15 * MINUTE,
+    const.MARKET_TYPE_KLINE_30M: 30 * MINUTE,
+    const.MARKET_TYPE_KLINE_1H: 60 * MINUTE,
+    const.MARKET_TYPE_KLINE_3H: 180 * MINUTE,
+    const.MARKET_TYPE_KLINE_6H: 360 * MINUTE,
+    const.MARKET_TYPE_KLINE_12H: 720 * MINUTE,
+    const.MARKET_TYPE_KLINE_1D: DAY,
+    const.MARKET_TYPE_KLINE_3D: 3 * DAY,
+    const.MARKET_TYPE_KLINE_1W: 7 * DAY,
+    const.MARKET_TYPE_KLINE_15D: 15 * DAY,
+    const.MARKET_TYPE_KLINE_1MON: None,
+    const.MARKET_TYPE_KLINE_1Y: None
+}
+
+
+def get_kline_period(kline_type, timestamp):
+    """Get the period of a kline type which a timestamp falls into, all periods are in UTC.
+
+    Args:
+        kline_type: Kline type, e.g. `kline_5m`.
+        timestamp: Timestamp, millisecond.
+
+    Returns:
+        start: Period start timestamp(millisecond), included.
+        end: Period end timestamp(millisecond), excluded.
+
+    * NOTE:
+        Periods are aligned to 1970-01-01 00:00:00 UTC, except that a week starts on Monday, a month on the first day
+        of the month and a year on January 1st.
+    """
+    interval = KLINE_INTERVALS[kline_type]
+    if kline_type == const.MARKET_TYPE_KLINE_1W:
+        start = timestamp - (timestamp - 4 * DAY) % interval  # 1970-01-05 is Monday.
+        return start, start + interval
+    if interval:
+        start = timestamp - timestamp % interval
+        return start, start + interval
+    dt = datetime.datetime.utcfromtimestamp(timestamp // 1000)
+    if kline_type == const.MARKET_TYPE_KLINE_1MON:
+        begin = datetime.datetime(dt.year, dt.month, 1)
+        finish = datetime.datetime(dt.year + dt.month // 12, dt.month % 12 + 1, 1)
+    else:
+        begin = datetime.datetime(dt.year, 1, 1)
+        finish = datetime.datetime(dt.year + 1, 1, 1)
+    epoch = datetime.datetime(1970, 1, 1)
+    return (int((begin - epoch).total_seconds()) * 1000, int((finish - epoch).total_seconds()) * 1000)
+
+
+class KlineAggregator:
+    """Multi-timeframe kline aggregator, build 1 minute klines from trades and roll them up into all higher kline
+    types, so one trade feed replaces the kline feeds.
+
+    Args:
+        platform: Exchange platform name, e.g. `binance` / `bitmex`.
+        symbol: Trade pair name, e.g. `ETH/BTC`.
+        callback: Asynchronous callback function for closed klines, e.g. `async def on_kline(kline: Kline): pass`.
+        kline_types: Kline types to build, default is all kline types in `KLINE_INTERVALS`.
+        partial_callback: Asynchronous callback function for the klines not closed yet, called after every trade
+            with all kline types updated by it. Default is None.
+        publish: If True, the closed klines are published to the event center by `EventKline`. Default is False.
+        volume_precision: Decimal places of the volume string, default is `8`.
+        close_delay: If set, the klines are closed by a timer `close_delay` seconds after their periods end, even if
+            no more trades come, according to the local clock. Default is None, a kline is closed by the first trade
+            of the next period, or by `flush`.
+
+    * NOTE:
+        A trade only updates the current 1 minute kline, higher klines are updated when a 1 minute kline is closed, so
+        the cost per trade is O(1). Periods without trades produce no kline.
+        Trades older than the current 1 minute kline are merged into it (volume, high and low), open and close are
+        not changed.
+        Usage: `Market(const.MARKET_TYPE_TRADE, platform, symbol, aggregator.on_trade)`
+    """
+
+    def __init__(self, platform, symbol, callback=None, kline_types=None, partial_callback=None, publish=False,
+                 volume_precision=8, close_delay=None):
+        """Initialize."""
+        self._platform = platform
+        self._symbol = symbol
+        self._callback = callback
+        self._partial_callback = partial_callback
+        self._publish = publish
+        self._volume_format = "%.{}f".format(volume_precision)
+        self._close_delay = close_delay
+        kline_types = kline_types or list(KLINE_INTERVALS.keys())
+        self._higher_types = [kt for kt in KLINE_INTERVALS if kt in kline_types and kt != const.MARKET_TYPE_KLINE]
+        self._emit_minute = const.MARKET_TYPE_KLINE in kline_types
+        self._minute = None  # Current 1 minute bar.
+        self._bars = {}  # Current bar per higher kline type, e.g. `{"kline_5m": bar}`
+        if close_delay is not None:
+            LoopRunTask.register(self._on_close_timer, 1)
+
+    @staticmethod
+    def _new_bar(start, end, price, quantity):
+        # Bar: [start, end, open, high, low, close, float high, float low, volume], prices are the trade strings.
+        return [start, end, price, price, price, price, float(price), float(price), quantity]
+
+    async def on_trade(self, trade: Trade):
+        """Trade callback for `Market`."""
+        self.update(trade)
+
+    def update(self, trade: Trade):
+        """Update klines by a trade."""
+        timestamp, price, quantity = trade.timestamp, trade.price, float(trade.quantity)
+        bar = self._minute
+        if bar and timestamp >= bar[1]:
+            self._close_minute(timestamp)
+            bar = None
+        if bar is None:
+            start, end = get_kline_period(const.MARKET_TYPE_KLINE, timestamp)
+            bar = self._minute = self._new_bar(start, end, price, quantity)
+        else:
+            p = float(price)
+            if p > bar[6]:
+                bar[3], bar[6] = price, p
+            if p < bar[7]:
+                bar[4], bar[7] = price, p
+            if timestamp >= bar[0]:
+                bar[5] = price
+            bar[8] += quantity
+        if self._partial_callback:
+            if self._emit_minute:
+                SingleTask.run(self._partial_callback, self._to_kline(const.MARKET_TYPE_KLINE, bar))
+            for kline_type in self._higher_types:
+                higher = self._bars.get(kline_type)
+                if higher and bar[0] >= higher[1]:
+                    higher = None  # The higher bar will be closed with the current 1 minute bar.
+                SingleTask.run(self._partial_callback, self._to_kline(kline_type, self._merge(higher, bar, kline_type)))
+
+    def flush(self, timestamp=None):
+        """Close all klines whose periods end before `timestamp`(millisecond), all klines if `timestamp` is None."""
+        if self._minute and (timestamp is None or timestamp >= self._minute[1]):
+            self._close_minute()
+        for kline_type in self._higher_types:
+            bar = self._bars.get(kline_type)
+            if bar and (timestamp is None or timestamp >= bar[1]):
+                self._close(kline_type, self._bars.pop(kline_type))
+
+    async def _on_close_timer(self, *args, **kwargs):
+        self.flush(tools.get_cur_timestamp_ms() - int(self._close_delay * 1000))
+
+    def _close_minute(self, timestamp=None):
+        """Close the current 1 minute bar and roll it up into the higher bars, the higher bars whose periods end before
+        `timestamp`(millisecond, the trade closing the 1 minute bar) are closed too."""
+        minute, self._minute = self._minute, None
+        if self._emit_minute:
+            self._close(const.MARKET_TYPE_KLINE, minute)
+        for kline_type in self._higher_types:
+            bar = self._bars.get(kline_type)
+            if bar and minute[0] >= bar[1]:
+                self._close(kline_type, bar)
+                bar = None
+            bar = self._bars[kline_type] = self._merge(bar, minute, kline_type)
+            if timestamp is not None and timestamp >= bar[1]:
+                self._close(kline_type, self._bars.pop(kline_type))
+
+    def _merge(self, bar, minute, kline_type):
+        """Merge a 1 minute bar into a higher bar, returns a new bar."""
+        if bar is None:
+            start, end = get_kline_period(kline_type, minute[0])
+            return [start, end] + minute[2:]
+        high = (bar[3], bar[6]) if bar[6] >= minute[6] else (minute[3], minute[6])
+        low = (bar[4], bar[7]) if bar[7] <= minute[7] else (minute[4], minute[7])
+        return [bar[0], bar[1], bar[2], high[0], low[0], minute[5], high[1], low[1], bar[8] + minute[8]]
+
+    def _to_kline(self, kline_type, bar):
+        return Kline(self._platform, self._symbol, bar[2], bar[3], bar[4], bar[5], self._volume_format % bar[8],
+                     bar[0], kline_type)
+
+    def _close(self, kline_type, bar):
+        kline = self._to_kline(kline_type, bar)
+        if self._callback:
+            SingleTask.run(self._callback, kline)
+        if self._publish:
+            from aioquant.event import EventKline
+            EventKline(kline).publish()
+
+
+class TradeTape:
+    """Trade tape, a fixed capacity ring buffer of the latest trades of a symbol over preallocated columns (price,
+    quantity, side and timestamp), with rolling statistics over a count window and / or a time window, all updated in
+    O(1) per trade.
+
+    Args:
+        platform: Exchange platform name, e.g. `binance` / `bitmex`.
+        symbol: Trade pair name, e.g. `ETH/BTC`.
+        capacity: Count window, the tape keeps at most `capacity` latest trades, e.g. `500` for the last 500 trades.
+        window: Time window(millisecond), trades older than `window` before the newest trade are evicted, e.g. `10000`
+            for the last 10 seconds. Default is None, no time window.
+        callback: Asynchronous callback function called after every trade appended, e.g.
+            `async def on_trade(trade: Trade, tape: TradeTape): pass`. Default is None.
+
+    Attributes:
+        count: Trades in the window.
+        volume: Sum of quantities.
+        notional: Sum of `price * quantity`.
+        buy_volume: Sum of quantities of `BUY` trades.
+        sell_volume: Sum of quantities of `SELL` trades.
+
+    * NOTE:
+        High / low are kept by monotonic deques, the sums are recomputed from the columns once every `capacity`
+        evictions, so the floating point error does not accumulate.
+        The time window is based on the trade timestamps, call `evict` with the current timestamp to drop the old
+        trades when no more trades come.
+        Usage: `tape.attach()`, or `Market(const.MARKET_TYPE_TRADE, platform, symbol, tape.on_trade)`.
+    """
+
+    def __init__(self, platform, symbol, capacity=1000, window=None, callback=None):
+        """Initialize."""
+        self.platform = platform
+        self.symbol = symbol
+        self.capacity = capacity
+        self.window = window
+        self._callback = callback
+        self._prices = array("d", bytes(8 * capacity))
+        self._quantities = array("d", bytes(8 * capacity))
+        self._sides = array("b", bytes(capacity))  # 1 for BUY, -1 for SELL.
+        self._timestamps = array("q", bytes(8 * capacity))
+        self._head = 0  # Sequence of the oldest trade in the window.
+        self._tail = 0  # Sequence of the next trade.
+        self._evicted = 0  # Evictions since the sums were recomputed.
+        self._highs = deque()  # Sequences of the trades with descending prices.
+        self._lows = deque()  # Sequences of the trades with ascending prices.
+        self._newest = None  # Newest trade timestamp.
+        self.volume = 0.0
+        self.notional = 0.0
+        self.buy_volume = 0.0
+        self.sell_volume = 0.0
+
+    def attach(self, callback=None):
+        """Subscribe the trades of this symbol from the event center and append them to the tape.
+
+        Args:
+            callback: Asynchronous callback function called after every trade appended, replaces the one given
+                when initialized if not None.
+
+        Returns:
+            market: `Market` object, call `market.unsubscribe()` to detach.
+        """
+        if callback:
+            self._callback = callback
+        return Market(const.MARKET_TYPE_TRADE, self.platform, self.symbol, self.on_trade)
+
+    async def on_trade(self, trade: Trade):
+        """Trade callback for `Market`, trades of other symbols are ignored."""
+        if trade.platform != self.platform or trade.symbol != self.symbol:
+            return
+        self.append(trade.price, trade.quantity, trade.action, trade.timestamp)
+        if self._callback:
+            await self._callback(trade, self)
+
+    def append(self, price, quantity, action, timestamp):
+        """Append a trade, price and quantity can be string or number, timestamp is millisecond."""
+        price, quantity = float(price), float(quantity)
+        if self._tail - self._head == self.capacity:
+            self._evict_one()
+        if self._newest is None or timestamp > self._newest:
+            self._newest = timestamp
+        seq = self._tail
+        i = seq % self.capacity
+        self._prices[i] = price
+        self._quantities[i] = quantity
+        self._timestamps[i] = timestamp
+        self.volume += quantity
+        self.notional += price * quantity
+        if action == ORDER_ACTION_BUY:
+            self._sides[i] = 1
+            self.buy_volume += quantity
+        else:
+            self._sides[i] = -1
+            self.sell_volume += quantity
+        prices = self._prices
+        highs, lows = self._highs, self._lows
+        while highs and prices[highs[-1] % self.capacity] <= price:
+            highs.pop()
+        highs.append(seq)
+        while lows and prices[lows[-1] % self.capacity] >= price:
+            lows.pop()
+        lows.append(seq)
+        self._tail = seq + 1
+        if self.window is not None:
+            self.evict(self._newest)
+
+    def evict(self, timestamp):
+        """Evict the trades older than `window` before `timestamp`(millisecond)."""
+        if self.window is None:
+            return
+        expire = timestamp - self.window
+        while self._head < self._tail and self._timestamps[self._head % self.capacity] < expire:
+            self._evict_one()
+
+    def _evict_one(self):
+        i = self._head % self.capacity
+        price, quantity = self._prices[i], self._quantities[i]
+        self.volume -= quantity
+        self.notional -= price * quantity
+        if self._sides[i] == 1:
+            self.buy_volume -= quantity
+        else:
+            self.sell_volume -= quantity
+        if self._highs[0] == self._head:
+            self._highs.popleft()
+        if self._lows[0] == self._head:
+            self._lows.popleft()
+        self._head += 1
+        self._evicted += 1
+        if self._evicted >= self.capacity or self._head == self._tail:
+            self._resum()
+
+    def _resum(self):
+        """Recompute the sums from the columns."""
+        self._evicted = 0
+        self.volume = self.notional = self.buy_volume = self.sell_volume = 0.0
+        for seq in range(self._head, self._tail):
+            i = seq % self.capacity
+            quantity = self._quantities[i]
+            self.volume += quantity
+            self.notional += self._prices[i] * quantity
+            if self._sides[i] == 1:
+                self.buy_volume += quantity
+            else:
+                self.sell_volume += quantity
+
+    @property
+    def count(self):
+        return self._tail - self._head
+
+    @property
+    def vwap(self):
+        """Volume weighted average price, None if no volume."""
+        return self.notional / self.volume if self.volume else None
+
+    @property
+    def imbalance(self):
+        """Buy / sell volume imbalance, `(buy - sell) / (buy + sell)`, in `[-1, 1]`, None if no volume."""
+        total = self.buy_volume + self.sell_volume
+        if not total:
+            return None
+        return (self.buy_volume - self.sell_volume) / total
+
+    @property
+    def high(self):
+        return self._prices[self._highs[0] % self.capacity] if self._highs else None
+
+    @property
+    def low(self):
+        return self._prices[self._lows[0] % self.capacity] if self._lows else None
+
+    @property
+    def last_price(self):
+        return self._prices[(self._tail - 1) % self.capacity] if self._tail > self._head else None
+
+    def trades(self):
+        """Trades in the window from the oldest to the newest, e.g. `[(price, quantity, action, timestamp), ...]`."""
+        result = []
+        for seq in range(self._head, self._tail):
+            i = seq % self.capacity
+            action = ORDER_ACTION_BUY if self._sides[i] == 1 else ORDER_ACTION_SELL
+            result.append((self._prices[i], self._quantities[i], action, self._timestamps[i]))
+        return result
+
+    def __len__(self):
+        return self._tail - self._head
+
     def __str__(self):
-        info = json.dumps(self.data)
+        info = "[platform: {}, symbol: {}, count: {}, volume: {}, vwap: {}, high: {}, low: {}, imbalance: {}]".format(
+            self.platform, self.symbol, self.count, self.volume, self.vwap, self.high, self.low, self.imbalance)
         return info
 
     def __repr__(self):
@@ -226,20 +809,34 @@ class Market:
         callback: Asynchronous callback function for market data update.
                 e.g. async def on_event_kline_update(kline: Kline):
                         pass
+        conflate: Only for orderbook. If True, at most one callback is running at a time, and only the newest
+            orderbook is kept while the callback is running, the stale ones are skipped. Default is False.
+        batch: Only for trade. If True, the callback receives a list of trades per message, e.g. all trades of a trade
+            batch published by a market server with `batch_window` enabled. Default is False.
+        depth: Only for orderbook. How many levels needed, the smallest depth tier (`depth_tiers` in `Orderbook`
+            exchange options) covering it is subscribed, so the orderbook received may have more levels than `depth`.
+            Default is None, the full orderbook is subscribed.
+
+    * NOTE:
+        Call `unsubscribe` to stop receiving market data, e.g. a symbol is removed from the strategy's universe, the
+        consumer is cancelled and the queue is deleted by RabbitMQ. Subscribe again by creating a new `Market`.
     """
 
-    def __init__(self, market_type, platform, symbol, callback):
+    def __init__(self, market_type, platform, symbol, callback, conflate=False, batch=False, depth=None):
         """Initialize."""
+        self._event = None
         if platform == "#" or symbol == "#":
             multi = True
         else:
             multi = False
         if market_type == const.MARKET_TYPE_ORDERBOOK:
             from aioquant.event import EventOrderbook
-            EventOrderbook(Orderbook(platform, symbol)).subscribe(callback, multi)
+            self._event = EventOrderbook(Orderbook(platform, symbol), depth)
+            self._event.subscribe(callback, multi, conflate)
         elif market_type == const.MARKET_TYPE_TRADE:
             from aioquant.event import EventTrade
-            EventTrade(Trade(platform, symbol)).subscribe(callback, multi)
+            self._event = EventTrade(Trade(platform, symbol))
+            self._event.subscribe(callback, multi, batch=batch)
         elif market_type in [
             const.MARKET_TYPE_KLINE, const.MARKET_TYPE_KLINE_3M, const.MARKET_TYPE_KLINE_5M,
             const.MARKET_TYPE_KLINE_15M, const.MARKET_TYPE_KLINE_30M, const.MARKET_TYPE_KLINE_1H,
@@ -247,6 +844,13 @@ class Market:
             const.MARKET_TYPE_KLINE_1D, const.MARKET_TYPE_KLINE_3D, const.MARKET_TYPE_KLINE_1W,
             const.MARKET_TYPE_KLINE_15D, const.MARKET_TYPE_KLINE_1MON, const.MARKET_TYPE_KLINE_1Y]:
             from aioquant.event import EventKline
-            EventKline(Kline(platform, symbol, kline_type=market_type)).subscribe(callback, multi)
+            self._event = EventKline(Kline(platform, symbol, kline_type=market_type))
+            self._event.subscribe(callback, multi)
         else:
             logger.error("market_type error:", market_type, caller=self)
+
+    def unsubscribe(self):
+        """Unsubscribe this market data."""
+        if self._event:
+            self._event.unsubscribe()
+            self._event = None
@@ -12,13 +12,17 @@ Email:  huangtao@ifclover.com
 import json
 import copy
 import hmac
+import bisect
+import asyncio
 import hashlib
+from collections import deque
 
 from urllib.parse import urljoin
 
 from aioquant.error import Error
 from aioquant.utils import tools
 from aioquant.utils import logger
+from aioquant.market import Orderbook
 from aioquant.order import Order, TRADE_TYPE_BUY_OPEN
 from aioquant.tasks import SingleTask, LoopRunTask
 from aioquant.utils.decorator import async_method_locker
@@ -27,7 +31,7 @@ from aioquant.order import ORDER_ACTION_SELL, ORDER_ACTION_BUY, ORDER_TYPE_LIMIT
 from aioquant.order import ORDER_STATUS_SUBMITTED, ORDER_STATUS_PARTIAL_FILLED, ORDER_STATUS_FILLED, \
     ORDER_STATUS_CANCELED, ORDER_STATUS_FAILED
 
-__all__ = ("BinanceRestAPI", "BinanceTrade", )
+__all__ = ("BinanceRestAPI", "BinanceTrade", "BinanceOrderbook", )
 
 
 class BinanceRestAPI:
@@ -1382,3 +1386,221 @@ class BinanceTrade:
 
             if status in [ORDER_STATUS_FAILED, ORDER_STATUS_CANCELED, ORDER_STATUS_FILLED]:
                 self._orders.pop(order_id)
+
+
+class BookSide:
+    """One side of a L2 orderbook. Price levels are kept in a sorted list of price keys (binary search by `bisect`)
+    and a dict of levels, so the top levels are always in order and a level is found in O(log n).
+
+    Args:
+        descending: True for bids (highest price first), False for asks.
+    """
+
+    __slots__ = ("_descending", "_keys", "_levels", )
+
+    def __init__(self, descending=False):
+        """Initialize."""
+        self._descending = descending
+        self._keys = []  # Sorted price keys, negative prices for bids.
+        self._levels = {}  # e.g. `{price key: (price, quantity)}`, price and quantity are the original strings.
+
+    def __len__(self):
+        return len(self._keys)
+
+    def clear(self):
+        self._keys = []
+        self._levels = {}
+
+    def update(self, price, quantity):
+        """Set the quantity of a price level, zero quantity removes the level.
+
+        Args:
+            price: Price string, e.g. `"0.0024"`.
+            quantity: Quantity string, e.g. `"10.0"`.
+        """
+        key = -float(price) if self._descending else float(price)
+        if float(quantity) == 0:
+            if self._levels.pop(key, None) is not None:
+                del self._keys[bisect.bisect_left(self._keys, key)]
+            return
+        if key not in self._levels:
+            bisect.insort(self._keys, key)
+        self._levels[key] = (price, quantity)
+
+    def top(self, n=None):
+        """The best `n` levels, e.g. `[[price, quantity], ...]`, all levels if `n` is None."""
+        levels = self._levels
+        return [list(levels[key]) for key in self._keys[:n]]
+
+
+class BinanceOrderbook:
+    """Binance local L2 orderbook, bootstrapped from the REST depth snapshot and maintained by the `depthUpdate` diffs
+    of the `<symbol>@depth` stream.
+
+    Args:
+        rest_api: REST API client, `get_orderbook` is used to fetch the snapshot.
+        platform: Exchange platform name, e.g. `binance`.
+        symbol: Symbol name, e.g. `ETH/BTC`.
+        snapshot_limit: Snapshot depth, default is `1000`.
+        retry_interval: Seconds to wait before fetching the snapshot again, default is `1`.
+        buffer_size: Max diffs buffered while fetching the snapshot, default is `10000`.
+
+    Attributes:
+        synced: If the orderbook is in sync with Binance.
+        last_update_id: The last update id applied.
+        updates: How many diffs applied.
+        resyncs: How many times bootstrapped again because of gaps.
+
+    * NOTE:
+        Sequencing rules, see `How to manage a local order book correctly` of Binance websocket streams document:
+        1. Buffer the diffs of the stream, and fetch a snapshot.
+        2. Drop the diffs with `u` <= `lastUpdateId` of the snapshot.
+        3. The first diff applied must have `U` <= `lastUpdateId` + 1 and `u` >= `lastUpdateId` + 1.
+        4. Every diff after that must have `U` <= previous `u` + 1, otherwise some diffs are lost, the orderbook is
+           bootstrapped again from a new snapshot.
+        A diff carries the absolute quantities of the changed levels, so overlapped diffs can be applied again.
+    """
+
+    def __init__(self, rest_api: BinanceRestAPI, platform, symbol, snapshot_limit=1000, retry_interval=1,
+                 buffer_size=10000):
+        """Initialize."""
+        self._rest_api = rest_api
+        self._platform = platform
+        self._symbol = symbol
+        self._raw_symbol = symbol.replace("/", "")
+        self._snapshot_limit = snapshot_limit
+        self._retry_interval = retry_interval
+        self._asks = BookSide()
+        self._bids = BookSide(descending=True)
+        self._buffer = deque(maxlen=buffer_size)  # Diffs received while bootstrapping.
+        self._bootstrapping = False
+        self._timestamp = None  # Event time of the last diff applied, millisecond.
+        self._last_top = ({}, {})  # Top levels returned by the last `delta`, e.g. `({price: quantity}, {...})`
+        self.synced = False
+        self.last_update_id = None
+        self.updates = 0
+        self.resyncs = 0
+
+    def process(self, msg):
+        """Process a `depthUpdate` message.
+
+        Args:
+            msg: `depthUpdate` message, e.g. `{"e": "depthUpdate", "E": 123456789, "s": "BNBBTC", "U": 157, "u": 160,
+                "b": [["0.0024", "10"]], "a": [["0.0026", "100"]]}`
+
+        Returns:
+            applied: True if the diff is applied to the orderbook.
+        """
+        if not self.synced:
+            self._buffer.append(msg)
+            self._bootstrap()
+            return False
+        if msg["u"] <= self.last_update_id:
+            return False
+        if msg["U"] > self.last_update_id + 1:
+            logger.warn("depth update gap, resync. symbol:", self._symbol, "U:", msg["U"], "expect:",
+                        self.last_update_id + 1, caller=self)
+            self.synced = False
+            self.resyncs += 1
+            self._buffer.append(msg)
+            self._bootstrap()
+            return False
+        self._apply(msg)
+        return True
+
+    def _apply(self, msg):
+        update = self._asks.update
+        for price, quantity in msg["a"]:
+            update(price, quantity)
+        update = self._bids.update
+        for price, quantity in msg["b"]:
+            update(price, quantity)
+        self.last_update_id = msg["u"]
+        self._timestamp = msg.get("E")
+        self.updates += 1
+
+    def _bootstrap(self):
+        if not self._bootstrapping:
+            self._bootstrapping = True
+            SingleTask.run(self._fetch_snapshot)
+
+    async def _fetch_snapshot(self):
+        """Fetch snapshots until the buffered diffs can be applied to one of them."""
+        try:
+            while True:
+                success, error = await self._rest_api.get_orderbook(self._raw_symbol, self._snapshot_limit)
+                if error:
+                    logger.error("get orderbook snapshot error:", error, caller=self)
+                elif self.load_snapshot(success):
+                    return
+                await asyncio.sleep(self._retry_interval)
+        finally:
+            self._bootstrapping = False
+
+    def load_snapshot(self, snapshot):
+        """Load a depth snapshot and apply the buffered diffs after it.
+
+        Args:
+            snapshot: Depth snapshot, e.g. `{"lastUpdateId": 160, "bids": [["0.0024", "10"]], "asks": [...]}`
+
+        Returns:
+            synced: True if synced, False if the snapshot is older than the buffered diffs or some diffs are lost,
+                another snapshot is needed.
+        """
+        last_update_id = snapshot["lastUpdateId"]
+        diffs = [msg for msg in self._buffer if msg["u"] > last_update_id]
+        if diffs and diffs[0]["U"] > last_update_id + 1:
+            return False
+        for prev, msg in zip(diffs, diffs[1:]):
+            if msg["U"] > prev["u"] + 1:
+                self._buffer = deque(diffs[diffs.index(msg):], maxlen=self._buffer.maxlen)
+                return False
+        self._asks.clear()
+        self._bids.clear()
+        for price, quantity in snapshot["asks"]:
+            self._asks.update(price, quantity)
+        for price, quantity in snapshot["bids"]:
+            self._bids.update(price, quantity)
+        self.last_update_id = last_update_id
+        self._timestamp = tools.get_cur_timestamp_ms()
+        for msg in diffs:
+            self._apply(msg)
+        self._buffer.clear()
+        self.synced = True
+        logger.info("orderbook synced. symbol:", self._symbol, "last update id:", self.last_update_id, caller=self)
+        return True
+
+    def orderbook(self, depth=10):
+        """Get the top levels as a orderbook object.
+
+        Args:
+            depth: How many levels, None for all levels.
+
+        Returns:
+            orderbook: Orderbook object, None if not synced.
+        """
+        if not self.synced:
+            return None
+        return Orderbook(self._platform, self._symbol, self._asks.top(depth), self._bids.top(depth), self._timestamp)
+
+    def delta(self, depth=10):
+        """Get the top levels changed since the last call.
+
+        Args:
+            depth: How many levels.
+
+        Returns:
+            asks: Changed asks, e.g. `[[price, quantity], [price, None], ...]`, None for the levels removed from top.
+            bids: Changed bids, same as `asks`.
+            Both are None if not synced.
+        """
+        if not self.synced:
+            return None, None
+        top = (dict(self._asks.top(depth)), dict(self._bids.top(depth)))
+        changes = []
+        for old, new in zip(self._last_top, top):
+            changed = [[price, quantity] for price, quantity in new.items() if old.get(price) != quantity]
+            changed.extend([price, None] for price in old if price not in new)
+            changes.append(changed)
+        self._last_top = top
+        return changes[0], changes[1]
@@ -43,13 +43,23 @@ class AIOQuant:
         self._initialize(config_file)
         if entrance_func:
             if inspect.iscoroutinefunction(entrance_func):
-                self.loop.create_task(entrance_func())
+                self.loop.create_task(self._run_entrance(entrance_func))
             else:
                 entrance_func()
+                self.event_center.ready()
+        else:
+            self.event_center.ready()
 
         logger.info("start io loop ...", caller=self)
         self.loop.run_forever()
 
+    async def _run_entrance(self, entrance_func) -> None:
+        """Run the asynchronous entrance function, the event center is ready after it finished."""
+        try:
+            await entrance_func()
+        finally:
+            self.event_center.ready()
+
     def stop(self) -> None:
         """Stop the event loop."""
         logger.info("stop io loop.", caller=self)
@@ -76,8 +86,6 @@ class AIOQuant:
 
     def _init_event_center(self) -> None:
         """Initialize event center."""
-        if not config.rabbitmq:
-            return
         from aioquant.event import EventCenter
         self.event_center = EventCenter()
 
@@ -0,0 +1,196 @@
+# -*- coding:utf-8 -*-
+
+"""
+Shared memory ring buffer, one writer process and any number of reader processes on the same host.
+
+File layout:
+    header(64 bytes): magic(4 bytes) + slot size(uint32) + slot count(uint32) + padding(4 bytes) + epoch(uint64) +
+        write sequence(uint64) + heartbeat(uint64, millisecond timestamp) + padding
+    slots: `slot count` slots, every slot is `slot size` bytes: sequence(uint64) + payload length(uint32) + payload
+
+The writer marks a slot invalid (sequence `0`) before overwriting it, so a reader checks the slot sequence before
+and after copying the payload, if the sequence changed the writer has overrun the reader and the message is lost.
+The writer updates the heartbeat on every write and `touch`, so the readers can tell if the writer is still running.
+
+Author: HuangTao
+Date:   2019/11/28
+Email:  huangtao@ifclover.com
+"""
+
+import os
+import mmap
+import time
+import random
+import struct
+
+__all__ = ("RingBufferWriter", "RingBufferReader", )
+
+
+MAGIC = b"AQRB"
+HEADER = struct.Struct("<4sII4xQQ")
+HEADER_SIZE = 64
+SLOT_HEADER = struct.Struct("<QI")
+SEQ = struct.Struct("<Q")
+WRITE_SEQ_OFFSET = 24
+HEARTBEAT_OFFSET = 32
+
+
+class RingBufferWriter:
+    """Shared memory ring buffer writer.
+
+    Args:
+        path: Ring buffer file path, e.g. `/dev/shm/aioquant/Orderbook.binance.ETH_BTC`.
+        slot_size: Slot size(bytes), payload bigger than `slot_size - 12` can not be written.
+        slot_count: Slot count.
+
+    Attributes:
+        written: How many payloads written.
+        oversize: How many payloads dropped because they are too big.
+    """
+
+    def __init__(self, path, slot_size=65536, slot_count=1024):
+        """Initialize."""
+        self._slot_size = slot_size
+        self._slot_count = slot_count
+        self._seq = 0
+        self.written = 0
+        self.oversize = 0
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        size = HEADER_SIZE + slot_size * slot_count
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        # A new epoch tells the readers that the writer is restarted and the sequence starts from 0 again.
+        epoch = random.getrandbits(63) + 1
+        self._mm[:HEADER.size] = HEADER.pack(MAGIC, slot_size, slot_count, epoch, 0)
+        self.touch()
+
+    def touch(self):
+        """Update the heartbeat, a writer without payloads to write should touch at least once per second."""
+        SEQ.pack_into(self._mm, HEARTBEAT_OFFSET, int(time.time() * 1000))
+
+    def write(self, payload):
+        """Write a payload.
+
+        Args:
+            payload: Payload bytes.
+
+        Returns:
+            True if written, otherwise False(payload is too big).
+        """
+        if len(payload) > self._slot_size - SLOT_HEADER.size:
+            self.oversize += 1
+            return False
+        self._seq += 1
+        offset = HEADER_SIZE + ((self._seq - 1) % self._slot_count) * self._slot_size
+        start = offset + SLOT_HEADER.size
+        mm = self._mm
+        SEQ.pack_into(mm, offset, 0)
+        mm[start:start + len(payload)] = payload
+        SLOT_HEADER.pack_into(mm, offset, self._seq, len(payload))
+        SEQ.pack_into(mm, WRITE_SEQ_OFFSET, self._seq)
+        SEQ.pack_into(mm, HEARTBEAT_OFFSET, int(time.time() * 1000))
+        self.written += 1
+        return True
+
+    def close(self):
+        self._mm.close()
+
+
+class RingBufferReader:
+    """Shared memory ring buffer reader. If the writer is running already, the reader only reads the payloads written
+    after it's opened, otherwise it reads all payloads from the writer's beginning.
+
+    Args:
+        path: Ring buffer file path, the file may be created by the writer later.
+
+    Attributes:
+        received: How many payloads read.
+        overruns: How many payloads lost because the writer has overrun this reader.
+    """
+
+    def __init__(self, path):
+        """Initialize."""
+        self._path = path
+        self._mm = None
+        self._slot_size = 0
+        self._slot_count = 0
+        self._epoch = None  # Writer's epoch, `0` if waiting for a writer.
+        self._next_seq = 0  # Sequence of the next payload to read.
+        self.received = 0
+        self.overruns = 0
+
+    def _open(self):
+        if not os.path.exists(self._path):
+            self._epoch = 0
+            return False
+        with open(self._path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(mm) < HEADER_SIZE:
+            mm.close()
+            return False
+        magic, slot_size, slot_count, _, _ = HEADER.unpack_from(mm)
+        if magic != MAGIC or len(mm) < HEADER_SIZE + slot_size * slot_count:
+            mm.close()
+            return False
+        self._mm = mm
+        self._slot_size = slot_size
+        self._slot_count = slot_count
+        return True
+
+    def writer_alive(self, timeout):
+        """If the writer has updated the heartbeat in the last `timeout` seconds, False if there is no ring buffer
+        file (or it's written by a writer without heartbeat)."""
+        if not self._mm and not self._open():
+            return False
+        heartbeat = SEQ.unpack_from(self._mm, HEARTBEAT_OFFSET)[0]
+        return time.time() * 1000 - heartbeat <= timeout * 1000
+
+    def read(self, limit=1000):
+        """Read the payloads written since last read.
+
+        Args:
+            limit: Max payloads to read at a time.
+
+        Returns:
+            payloads: Payload bytes list.
+        """
+        if not self._mm and not self._open():
+            return []
+        _, _, _, epoch, write_seq = HEADER.unpack_from(self._mm)
+        if epoch != self._epoch:
+            # A new writer, read from it's first payload, unless this reader is just opened and the writer is running.
+            self._next_seq = write_seq + 1 if self._epoch is None else 1
+            self._epoch = epoch
+        if write_seq - self._next_seq + 1 > self._slot_count:
+            lost = write_seq - self._slot_count + 1 - self._next_seq
+            self.overruns += lost
+            self._next_seq += lost
+        payloads = []
+        mm = self._mm
+        while self._next_seq <= write_seq and len(payloads) < limit:
+            seq = self._next_seq
+            self._next_seq += 1
+            offset = HEADER_SIZE + ((seq - 1) % self._slot_count) * self._slot_size
+            slot_seq, length = SLOT_HEADER.unpack_from(mm, offset)
+            if slot_seq != seq:
+                self.overruns += 1
+                continue
+            start = offset + SLOT_HEADER.size
+            payload = mm[start:start + length]
+            if SEQ.unpack_from(mm, offset)[0] != seq:
+                self.overruns += 1
+                continue
+            payloads.append(payload)
+        self.received += len(payloads)
+        return payloads
+
+    def close(self):
+        if self._mm:
+            self._mm.close()
+            self._mm = None
@@ -26,6 +26,12 @@ def get_cur_timestamp_ms():
     return ts
 
 
+def get_cur_timestamp_us():
+    """Get current timestamp(microsecond)."""
+    ts = int(time.time() * 1000000)
+    return ts
+
+
 def get_datetime_str(fmt="%Y-%m-%d %H:%M:%S"):
     """Get date time string, year + month + day + hour + minute + second.
 
@@ -173,3 +179,29 @@ def float_to_str(f, p=20):
     d1 = ctx.create_decimal(repr(f))
     s = format(d1, 'f')
     return s
+
+
+def topic_match(pattern, routing_key):
+    """Check if a routing key matches a topic pattern, the same rules as RabbitMQ topic exchange.
+
+    Args:
+        pattern: Topic pattern, words are separated by `.`, `*` matches exactly one word, `#` matches zero or more
+            words, e.g. `binance.#`.
+        routing_key: Routing key, e.g. `binance.ETH/BTC`.
+
+    Returns:
+        True if matched, otherwise False.
+    """
+    def match(p, k):
+        if p == len(patterns):
+            return k == len(words)
+        if patterns[p] == "#":
+            return any(match(p + 1, i) for i in range(k, len(words) + 1))
+        if k == len(words):
+            return False
+        if patterns[p] == "*" or patterns[p] == words[k]:
+            return match(p + 1, k + 1)
+        return False
+    patterns = pattern.split(".")
+    words = routing_key.split(".")
+    return match(0, 0)
@@ -0,0 +1,121 @@
+# -*- coding:utf-8 -*-
+
+"""
+Binance local orderbook replay benchmark, replay synthetic `depthUpdate` diffs through `BinanceOrderbook` and measure
+updates per second, the final orderbook is verified against the reference orderbook the diffs are generated from.
+
+Usage:
+    python benchmark/binance_orderbook.py [--updates 200000] [--levels 1000] [--changes 5] [--gap-every 0]
+        [--top 20]
+
+    `--gap-every` drops a diff every N diffs to measure resyncing, `0` means no gap. A gap is found by the next diff,
+    so the verification fails if the last diff is dropped.
+    `--top` builds a top-N orderbook after every diff if greater than 0.
+
+Author: HuangTao
+Date:   2019/12/03
+Email:  huangtao@ifclover.com
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aioquant.platform.binance import BinanceOrderbook
+
+
+class ReplayExchange:
+    """Replay exchange, generates `depthUpdate` diffs from a reference orderbook, and serves depth snapshots as
+    `BinanceRestAPI` at the current replay position.
+
+    Args:
+        levels: Levels per side of the initial orderbook.
+        updates: How many diffs.
+        changes: Levels changed per diff.
+    """
+
+    def __init__(self, levels, updates, changes):
+        self.asks = {"%.2f" % (10000 + i * 0.01): "%.4f" % random.uniform(0.1, 5) for i in range(1, levels + 1)}
+        self.bids = {"%.2f" % (10000 - i * 0.01): "%.4f" % random.uniform(0.1, 5) for i in range(levels)}
+        self.update_id = 1000
+        self.position = 0  # How many diffs published.
+        self._applied = 0  # How many diffs applied to the snapshot books.
+        books = {"a": dict(self.asks), "b": dict(self.bids)}
+        self.diffs = []
+        update_id = self.update_id
+        for _ in range(updates):
+            d = {"a": [], "b": []}
+            for _ in range(changes):
+                side, sign = random.choice((("a", 1), ("b", -1)))
+                price = "%.2f" % (10000 + sign * random.randint(1, levels + 200) * 0.01)
+                if price in books[side] and random.random() < 0.3:
+                    del books[side][price]
+                    quantity = "0.0000"
+                else:
+                    quantity = books[side][price] = "%.4f" % random.uniform(0.1, 5)
+                d[side].append([price, quantity])
+            self.diffs.append({"e": "depthUpdate", "E": 1575000000000, "s": "BTCUSDT", "U": update_id + 1,
+                               "u": update_id + changes, "b": d["b"], "a": d["a"]})
+            update_id += changes
+
+    def _catch_up(self):
+        for msg in self.diffs[self._applied:self.position]:
+            for side, book in (("a", self.asks), ("b", self.bids)):
+                for price, quantity in msg[side]:
+                    if float(quantity) == 0:
+                        book.pop(price, None)
+                    else:
+                        book[price] = quantity
+            self.update_id = msg["u"]
+        self._applied = self.position
+
+    async def get_orderbook(self, symbol, limit=10):
+        self._catch_up()
+        asks = sorted(self.asks.items(), key=lambda x: float(x[0]))[:limit]
+        bids = sorted(self.bids.items(), key=lambda x: -float(x[0]))[:limit]
+        return {"lastUpdateId": self.update_id, "asks": [list(x) for x in asks], "bids": [list(x) for x in bids]}, None
+
+
+async def run(args):
+    """Replay all diffs, returns the orderbook engine, the replay exchange and the seconds elapsed."""
+    exchange = ReplayExchange(args.levels, args.updates, args.changes)
+    book = BinanceOrderbook(exchange, "binance", "BTC/USDT", snapshot_limit=args.levels * 10)
+    start = time.perf_counter()
+    for index, msg in enumerate(exchange.diffs):
+        exchange.position = index + 1
+        if args.gap_every and index % args.gap_every == args.gap_every - 1:
+            continue
+        book.process(msg)
+        while not book.synced:
+            await asyncio.sleep(0)  # Let the snapshot task run.
+        if args.top:
+            book.orderbook(args.top)
+    elapsed = time.perf_counter() - start
+    return book, exchange, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Binance local orderbook replay benchmark.")
+    parser.add_argument("--updates", type=int, default=200000, help="How many diffs.")
+    parser.add_argument("--levels", type=int, default=1000, help="Levels per side of the initial orderbook.")
+    parser.add_argument("--changes", type=int, default=5, help="Levels changed per diff.")
+    parser.add_argument("--gap-every", type=int, default=0, help="Drop a diff every N diffs, 0 is no gap.")
+    parser.add_argument("--top", type=int, default=0, help="Build a top-N orderbook after every diff.")
+    args = parser.parse_args()
+    book, exchange, elapsed = asyncio.get_event_loop().run_until_complete(run(args))
+
+    exchange.position = len(exchange.diffs)
+    expected, _ = asyncio.get_event_loop().run_until_complete(exchange.get_orderbook("BTCUSDT", args.levels * 10))
+    orderbook = book.orderbook(None)
+    verified = orderbook.asks == expected["asks"] and orderbook.bids == expected["bids"]
+    print("applied: {} resyncs: {} elapsed: {:.3f}s updates/s: {:.0f} levels/s: {:.0f} verified: {}".format(
+        book.updates, book.resyncs, elapsed, book.updates / elapsed, book.updates * args.changes / elapsed, verified))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# -*- coding:utf-8 -*-
+
+"""
+Event codec micro benchmark, compare encode / decode throughput and message size of all registered codecs.
+
+Usage:
+    python benchmark/codec.py [--number 20000] [--depth 20] [--threshold 256] [--level 1]
+
+Author: HuangTao
+Date:   2019/11/21
+Email:  huangtao@ifclover.com
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aioquant import codec
+from aioquant.codec import CompressionPolicy
+from aioquant.market import Orderbook, Trade, Kline
+
+
+def create_samples(depth):
+    """Create sample messages, `[(name, data), ...]`."""
+    ts = int(time.time() * 1000)
+    asks = [["%.8f" % (8680.7 + i * 0.1), "%.8f" % random.random()] for i in range(depth)]
+    bids = [["%.8f" % (8680.6 - i * 0.1), "%.8f" % random.random()] for i in range(depth)]
+    orderbook = Orderbook("binance", "ETH/USDT", asks, bids, ts)
+    trade = Trade("binance", "ETH/USDT", "BUY", "8680.70000000", "0.00200000", ts)
+    kline = Kline("binance", "ETH/USDT", "8665.50000000", "8668.40000000", "8660.00000000", "8660.00000000",
+                  "73.14728136", ts, "kline")
+    return [("EVENT_ORDERBOOK", orderbook.smart), ("EVENT_TRADE", trade.smart), ("EVENT_KLINE", kline.smart)]
+
+
+def bench(func, number):
+    """Run `func` for `number` times, return operations per second."""
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return number / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Event codec micro benchmark.")
+    parser.add_argument("--number", type=int, default=20000, help="Iterations per case.")
+    parser.add_argument("--depth", type=int, default=20, help="Orderbook depth.")
+    parser.add_argument("--threshold", type=int, default=256, help="Compression policy threshold(bytes).")
+    parser.add_argument("--level", type=int, default=1, help="Compression policy zlib level.")
+    args = parser.parse_args()
+
+    print("{:<16} {:<8} {:<8} {:>12} {:>12} {:>8}".format("event", "codec", "policy", "encode/s", "decode/s",
+                                                           "bytes"))
+    for name, data in create_samples(args.depth):
+        for codec_name in codec.CODECS:
+            for policy in (None, CompressionPolicy(args.threshold, args.level)):
+                b = codec.dumps(name, data, codec_name, policy)
+                assert codec.loads(b) == (name, data)
+                encode = bench(lambda: codec.dumps(name, data, codec_name, policy), args.number)
+                decode = bench(lambda: codec.loads(b), args.number)
+                print("{:<16} {:<8} {:<8} {:>12.0f} {:>12.0f} {:>8}".format(name, codec_name, "yes" if policy else "no",
+                                                                           encode, decode, len(b)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# -*- coding:utf-8 -*-
+
+"""
+Event consume benchmark, publish trade events to RabbitMQ and measure how many messages per second are consumed
+with different acknowledgement settings:
+    a) ack: prefetch_count=1, acknowledge every message (the original behaviour);
+    b) batch: bigger prefetch window and cumulative acknowledgements;
+    c) no_ack: no acknowledgement at all.
+
+Usage:
+    python benchmark/consume.py --config config.json [--number 20000] [--prefetch 500] [--ack-batch 100]
+
+    The config file must contain a `RABBITMQ` block.
+
+Author: HuangTao
+Date:   2019/11/25
+Email:  huangtao@ifclover.com
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aioquant import quant
+from aioquant.configure import config
+from aioquant.market import Trade
+from aioquant.event import EventCenter, EventTrade
+
+
+async def run(mode, number, options):
+    """Publish `number` trades and consume them, return messages per second."""
+    config.rabbitmq["exchanges"] = {"Trade": options}
+    quant.event_center = EventCenter()
+    received = 0
+    done = asyncio.Event()
+
+    async def on_trade(trade):
+        nonlocal received
+        received += 1
+        if received == number:
+            done.set()
+
+    symbol = "BENCH/{}".format(mode.upper())
+    await quant.event_center.subscribe(EventTrade(Trade("benchmark", symbol)), on_trade)
+    quant.event_center.ready()
+    await asyncio.sleep(1)
+
+    start = time.perf_counter()
+    for i in range(number):
+        EventTrade(Trade("benchmark", symbol, "BUY", "8680.70000000", "0.00200000", i)).publish()
+    await done.wait()
+    return number / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Event consume benchmark.")
+    parser.add_argument("--config", required=True, help="Config file with RABBITMQ block.")
+    parser.add_argument("--number", type=int, default=20000, help="Messages per mode.")
+    parser.add_argument("--prefetch", type=int, default=500, help="Prefetch count for `batch` and `no_ack` mode.")
+    parser.add_argument("--ack-batch", type=int, default=100, help="Cumulative acknowledgement batch size.")
+    args = parser.parse_args()
+
+    config.loads(args.config)
+    modes = [
+        ("ack", {}),
+        ("batch", {"prefetch_count": args.prefetch, "ack_batch": args.ack_batch, "ack_interval": 50}),
+        ("no_ack", {"prefetch_count": args.prefetch, "no_ack": True})
+    ]
+    loop = asyncio.get_event_loop()
+    for mode, options in modes:
+        rate = loop.run_until_complete(run(mode, args.number, options))
+        print("{:<8} {:>12.0f} messages/s".format(mode, rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# -*- coding:utf-8 -*-
+
+"""
+Event center end-to-end benchmark, publish Orderbook / Trade / Kline events through the in-memory broker
+(`RABBITMQ.transport` is `memory`, no RabbitMQ server is needed) and measure publish -> callback throughput and
+latency, the whole path is covered: publish queue, encoding, routing, consuming, decoding and acknowledgement.
+
+Usage:
+    python benchmark/event_center.py [--events orderbook,trade,kline] [--rate 0] [--duration 5] [--codec json]
+        [--depth 20] [--prefetch 1] [--ack-batch 1] [--batch-window 0]
+
+    `--rate` is events per second per event type, `0` means as fast as possible.
+    `--batch-window` packs trades into trade batches (milliseconds), compare the broker message count with `0`.
+
+Author: HuangTao
+Date:   2019/11/29
+Email:  huangtao@ifclover.com
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aioquant import quant
+from aioquant.broker import broker
+from aioquant.configure import config
+from aioquant.market import Orderbook, Trade, Kline
+from aioquant.event import EventCenter, EventOrderbook, EventTrade, EventKline
+
+
+def create_event(kind, seq, asks, bids):
+    """Create a event, the sequence number is carried by the timestamp field."""
+    if kind == "orderbook":
+        return EventOrderbook(Orderbook("benchmark", "BENCH/USDT", asks, bids, seq))
+    if kind == "trade":
+        return EventTrade(Trade("benchmark", "BENCH/USDT", "BUY", "8680.70000000", "0.00200000", seq))
+    return EventKline(Kline("benchmark", "BENCH/USDT", "8665.50000000", "8668.40000000", "8660.00000000",
+                            "8660.00000000", "73.14728136", seq, "kline"))
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def run(kinds, rate, duration, depth):
+    """Publish events of every kind for `duration` seconds and collect latencies.
+
+    Returns:
+        results: e.g. `{"trade": {"published": 100, "latencies": [0.0001, ...]}}`
+        elapsed: Seconds from the first publish to the last callback.
+    """
+    asks = [["%.8f" % (8680.7 + i * 0.1), "%.8f" % random.random()] for i in range(depth)]
+    bids = [["%.8f" % (8680.6 - i * 0.1), "%.8f" % random.random()] for i in range(depth)]
+    results = {kind: {"published": 0, "latencies": [], "sent": {}} for kind in kinds}
+    last_received = 0
+
+    def on_event(kind):
+        result = results[kind]
+
+        async def callback(o):
+            nonlocal last_received
+            last_received = time.perf_counter()
+            result["latencies"].append(last_received - result["sent"].pop(o.timestamp))
+        return callback
+
+    for kind in kinds:
+        await quant.event_center.subscribe(create_event(kind, 0, asks, bids), on_event(kind))
+    quant.event_center.ready()
+    await asyncio.sleep(0.1)
+
+    start = time.perf_counter()
+    seq = 0
+    while time.perf_counter() - start < duration:
+        if rate:
+            due = int((time.perf_counter() - start) * rate) - results[kinds[0]]["published"]
+        else:
+            due = 100
+        for _ in range(due):
+            seq += 1
+            for kind in kinds:
+                result = results[kind]
+                event = create_event(kind, seq, asks, bids)
+                result["sent"][seq] = time.perf_counter()
+                event.publish()
+                result["published"] += 1
+        await asyncio.sleep(0.001 if rate else 0)
+
+    # Wait for the events in flight.
+    deadline = time.perf_counter() + 5
+    while any(result["sent"] for result in results.values()) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    return results, last_received - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Event center end-to-end benchmark.")
+    parser.add_argument("--events", default="orderbook,trade,kline", help="Event types, separated by `,`.")
+    parser.add_argument("--rate", type=int, default=0, help="Events per second per type, 0 is as fast as possible.")
+    parser.add_argument("--duration", type=float, default=5, help="Publishing seconds.")
+    parser.add_argument("--codec", default="json", help="Codec name, `json` / `binary`.")
+    parser.add_argument("--depth", type=int, default=20, help="Orderbook depth.")
+    parser.add_argument("--prefetch", type=int, default=1, help="Consumer prefetch count.")
+    parser.add_argument("--ack-batch", type=int, default=1, help="Cumulative acknowledgement batch size.")
+    parser.add_argument("--batch-window", type=float, default=0, help="Trade batch window(ms), 0 is no batching.")
+    args = parser.parse_args()
+
+    kinds = args.events.split(",")
+    exchange = {"prefetch_count": args.prefetch, "ack_batch": args.ack_batch, "ack_interval": 10}
+    config.rabbitmq = {
+        "transport": "memory",
+        "codec": args.codec,
+        "exchanges": {"Orderbook": exchange, "Trade": dict(exchange, batch_window=args.batch_window), "Kline": exchange}
+    }
+    quant.event_center = EventCenter()
+    results, elapsed = asyncio.get_event_loop().run_until_complete(run(kinds, args.rate, args.duration, args.depth))
+
+    print("{:<10} {:>10} {:>10} {:>8} {:>12} {:>10} {:>10} {:>10}".format(
+        "event", "published", "received", "lost", "events/s", "p50(us)", "p99(us)", "max(us)"))
+    for kind in kinds:
+        result = results[kind]
+        latencies = sorted(result["latencies"])
+        print("{:<10} {:>10} {:>10} {:>8} {:>12.0f} {:>10.0f} {:>10.0f} {:>10.0f}".format(
+            kind, result["published"], len(latencies), len(result["sent"]), len(latencies) / elapsed,
+            percentile(latencies, 0.5) * 1e6, percentile(latencies, 0.99) * 1e6,
+            (latencies[-1] if latencies else 0) * 1e6))
+    print("broker:", {k: v for k, v in broker.stats.items() if k != "queues"})
+
+
+if __name__ == "__main__":
+    main()
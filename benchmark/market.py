@@ -0,0 +1,144 @@
+# -*- coding:utf-8 -*-
+
+"""
+Market object benchmark, compare the `__slots__` market objects with the original dict-backed ones: memory of holding
+many trades, creation, `from_smart` and repeated `smart` / `str` access.
+
+Usage:
+    python benchmark/market.py [--count 200000] [--access 3]
+
+    `load` is `from_smart` (`load_smart` for the original objects), `smart` / `str` are per access.
+    `bytes/obj` is measured right after creation, `accessed` after `smart` and `str` are accessed once per object
+    (as publishing and logging do) while the objects are still held.
+
+Author: HuangTao
+Date:   2019/12/02
+Email:  huangtao@ifclover.com
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aioquant.market import Trade
+
+
+class LegacyTrade:
+    """The original dict-backed trade object."""
+
+    def __init__(self, platform=None, symbol=None, action=None, price=None, quantity=None, timestamp=None):
+        self.platform = platform
+        self.symbol = symbol
+        self.action = action
+        self.price = price
+        self.quantity = quantity
+        self.timestamp = timestamp
+
+    @property
+    def data(self):
+        d = {
+            "platform": self.platform,
+            "symbol": self.symbol,
+            "action": self.action,
+            "price": self.price,
+            "quantity": self.quantity,
+            "timestamp": self.timestamp
+        }
+        return d
+
+    @property
+    def smart(self):
+        d = {
+            "p": self.platform,
+            "s": self.symbol,
+            "a": self.action,
+            "P": self.price,
+            "q": self.quantity,
+            "t": self.timestamp
+        }
+        return d
+
+    def load_smart(self, d):
+        self.platform = d["p"]
+        self.symbol = d["s"]
+        self.action = d["a"]
+        self.price = d["P"]
+        self.quantity = d["q"]
+        self.timestamp = d["t"]
+        return self
+
+    def __str__(self):
+        return json.dumps(self.data)
+
+
+def measure(cls, count, access):
+    """Measure a trade class.
+
+    Returns:
+        result: e.g. `{"bytes/obj": 100, "accessed": 100, "create": 0.1, "from_smart": 0.1, "smart": 0.1, "str": 0.1}`,
+            times are microseconds per object (per access for `smart` / `str`).
+    """
+    prices = ["%.8f" % (8680 + i * 0.01) for i in range(1000)]
+    result = {}
+
+    def create():
+        return [cls("binance", "ETH/USDT", "BUY", prices[i % 1000], "0.00200000", 1575000000000 + i)
+                for i in range(count)]
+
+    tracemalloc.start()
+    trades = create()
+    result["bytes/obj"] = tracemalloc.get_traced_memory()[0] / count
+    for trade in trades:
+        trade.smart
+        str(trade)
+    result["accessed"] = tracemalloc.get_traced_memory()[0] / count
+    tracemalloc.stop()
+    del trades
+
+    start = time.perf_counter()
+    trades = create()
+    result["create"] = (time.perf_counter() - start) / count * 1e6
+
+    smarts = [trade.smart for trade in trades]
+    start = time.perf_counter()
+    if hasattr(cls, "from_smart"):
+        [cls.from_smart(d) for d in smarts]
+    else:
+        [cls().load_smart(d) for d in smarts]
+    result["from_smart"] = (time.perf_counter() - start) / count * 1e6
+
+    start = time.perf_counter()
+    for _ in range(access):
+        for trade in trades:
+            trade.smart
+    result["smart"] = (time.perf_counter() - start) / count / access * 1e6
+
+    start = time.perf_counter()
+    for _ in range(access):
+        for trade in trades:
+            str(trade)
+    result["str"] = (time.perf_counter() - start) / count / access * 1e6
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Market object benchmark.")
+    parser.add_argument("--count", type=int, default=200000, help="How many trades.")
+    parser.add_argument("--access", type=int, default=3, help="How many times `smart` / `str` accessed per trade.")
+    args = parser.parse_args()
+
+    print("{:<10} {:>10} {:>10} {:>12} {:>12} {:>12} {:>12}".format(
+        "class", "bytes/obj", "accessed", "create(us)", "load(us)", "smart(us)", "str(us)"))
+    for name, cls in (("legacy", LegacyTrade), ("slots", Trade)):
+        r = measure(cls, args.count, args.access)
+        print("{:<10} {:>10.0f} {:>10.0f} {:>12.3f} {:>12.3f} {:>12.3f} {:>12.3f}".format(
+            name, r["bytes/obj"], r["accessed"], r["create"], r["from_smart"], r["smart"], r["str"]))
+
+
+if __name__ == "__main__":
+    main()